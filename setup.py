@@ -1,8 +1,10 @@
 from setuptools import setup
 
+from ta import __version__
+
 setup(
     name='tissue-analysis',
-    version='1.2',
+    version=__version__,
     packages=['ta'],
     install_requires=['numpy', 'scipy', 'Pillow', 'pytess', 'xlrd'],
     entry_points={
@@ -12,7 +14,10 @@ setup(
             'pmesh = ta.plt:mesh',
             'plattice = ta.mesh:lattice',
             'pentropy = ta.entropy:main',
-            'pvoronoi = ta.voronoi:main'
+            'pvoronoi = ta.voronoi:main',
+            'tbench = ta.bench:main',
+            'tmerge = ta.summary:merge',
+            'texport = ta.summary:export'
             ]
         }
     )
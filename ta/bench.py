@@ -0,0 +1,286 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from glob import glob
+from multiprocessing import Pool
+from os import path
+
+from ta import __version__
+from cache import load
+from clusters import clusters
+from entropy import distribution, paths
+from mesh import mklattice
+from plt import extent, render
+from timing import peak, rss
+from vtu import VtuMesh
+
+log = logging.getLogger("bench")
+
+def _source(spec):
+    """
+    Load a benchmark source, either a mesh file or a synthetic lattice
+    given as lattice:NxM
+    """
+    if spec.startswith("lattice:"):
+        n, m = spec[len("lattice:"):].split("x")
+        return mklattice(int(n), int(m), "random", 0)
+    return load(spec)
+
+def _load(spec):
+    """
+    Load a source and decode what a VTU file only reads when it is
+    first needed, so that all of the parsing counts as loading
+    """
+    mesh = _source(spec)
+    mesh.types
+    if isinstance(mesh, VtuMesh):
+        mesh.cells
+        mesh.points
+    return mesh
+
+def _adjacencies(mesh, n):
+    mesh.adjacencies
+    mesh.neighbourIndex
+
+def _stats(mesh, n):
+    mesh.neighbourStats
+    mesh.entropy
+
+def _clusters(mesh, n):
+    clusters(mesh)
+
+def _paths(mesh, n):
+    distribution(mesh, paths(mesh, n))
+
+def _render(mesh, n):
+    lo, hi, mint, maxt = extent(mesh)
+    render(mesh, (640, 480), (lo, hi), (mint, maxt), ncolours=3)
+
+## each stage is the work that is timed and what must be done first
+stages = {
+    "load": (None, []),
+    "adjacencies": (_adjacencies, []),
+    "stats": (_stats, [_adjacencies]),
+    "clusters": (_clusters, [_adjacencies]),
+    "paths": (_paths, [_adjacencies]),
+    "render": (_render, []),
+}
+
+def _forked(work, mesh, n):
+    """
+    Run work(mesh, n) in a forked child and return its time and the
+    memory it added. A forked child's high-water mark starts at its
+    resident size, so memory used before the fork is not counted.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(r)
+            baseline = rss()
+            start = time.time()
+            work(mesh, n)
+            seconds = time.time() - start
+            os.write(w, json.dumps([seconds, max(0, peak() - baseline)]))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(w)
+    with os.fdopen(r) as fp:
+        out = fp.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError("stage failed in child process %d" % pid)
+    return json.loads(out)
+
+def _measure(job):
+    """
+    Time one stage on one source. This runs in a fresh worker process
+    so that its peak memory can be told apart from everything else,
+    and stages other than loading run in a child forked after their
+    setup so that the setup's memory is not charged to them.
+    """
+    spec, stage, n = job
+    work, setup = stages[stage]
+    if work is None:
+        start = time.time()
+        baseline = rss()
+        mesh = _load(spec)
+        seconds, peak_kb = time.time() - start, max(0, peak() - baseline)
+    else:
+        mesh = _load(spec)
+        for s in setup:
+            s(mesh, n)
+        mesh.geometry
+        seconds, peak_kb = _forked(work, mesh, n)
+    return {
+        "source": spec,
+        "cells": len(mesh),
+        "stage": stage,
+        "n": n,
+        "seconds": seconds,
+        "peak_kb": peak_kb,
+    }
+
+def run(sources, stagenames, pathlengths, repeat=1, maxpaths=None):
+    """
+    Measure every stage on every source, keeping the fastest of
+    repeat runs. Path enumeration is exponential in the path length,
+    so it is skipped for sources with more than maxpaths cells.
+    """
+    jobs = []
+    for spec in sources:
+        for stage in stagenames:
+            if stage == "paths":
+                if maxpaths is not None and len(_source(spec)) > maxpaths:
+                    continue
+                for n in pathlengths:
+                    jobs.append((spec, stage, n))
+            else:
+                jobs.append((spec, stage, None))
+    results = []
+    for job in jobs:
+        best = None
+        for _ in range(repeat):
+            pool = Pool(1)
+            result = pool.apply(_measure, (job,))
+            pool.close()
+            pool.join()
+            if best is None or result["seconds"] < best["seconds"]:
+                best = result
+        log.info("%(source)s %(stage)s %(n)s: %(seconds).4fs %(peak_kb)dkB", best)
+        results.append(best)
+    return results
+
+def _key(result):
+    return (result["source"], result["stage"], result["n"])
+
+def compare(baseline, results, threshold):
+    """
+    Report results that are slower than baseline by more than the
+    threshold ratio, returning the number of regressions
+    """
+    old = dict((_key(r), r) for r in baseline)
+    regressions = 0
+    for r in results:
+        b = old.get(_key(r))
+        if b is None or b["seconds"] <= 0:
+            continue
+        ratio = r["seconds"] / b["seconds"]
+        flag = ""
+        if ratio > threshold:
+            flag = " REGRESSION"
+            regressions += 1
+        print "%s %s %s: %.4fs -> %.4fs (x%.2f)%s" % (
+            r["source"], r["stage"], r["n"], b["seconds"], r["seconds"], ratio, flag)
+    return regressions
+
+## modules that no command should load before it needs them
+heavy = ("vtk", "scipy.sparse", "PIL", "pytess")
+
+## the modules behind the console scripts
+entrypoints = ("ta.cmd", "ta.entropy", "ta.mesh", "ta.plt", "ta.summary", "ta.voronoi")
+
+_probe = "import sys; import %s; sys.stdout.write(' '.join(m for m in %r if m in sys.modules))"
+
+def startup(modules, repeat=1):
+    """
+    Time a fresh interpreter importing each module, keeping the
+    fastest of repeat runs, and list the heavy modules it loaded
+    """
+    results = []
+    for module in modules:
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            out = subprocess.check_output([sys.executable, "-c", _probe % (module, heavy)])
+            seconds = time.time() - start
+            if best is None or seconds < best:
+                best = seconds
+        results.append({"module": module, "seconds": best, "loaded": out.split()})
+    return results
+
+def checkstartup(results, budget):
+    """
+    Report entry points that take longer than budget seconds to
+    start or load heavy modules, returning the number of failures
+    """
+    failures = 0
+    for r in results:
+        flag = ""
+        if r["loaded"]:
+            flag += " loads %s" % ",".join(r["loaded"])
+        if r["seconds"] > budget:
+            flag += " OVER BUDGET"
+        if flag:
+            failures += 1
+        print "%s: %.3fs%s" % (r["module"], r["seconds"], flag)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(prog='tbench')
+    parser.add_argument('-o', dest='output', default='bench.json',
+                        help='file to save results to')
+    parser.add_argument('-r', dest='repeat', default=3, type=int,
+                        help='runs of each measurement, the fastest is kept')
+    parser.add_argument('-s', dest='stages', default=",".join(sorted(stages)),
+                        help='comma separated stages to measure')
+    parser.add_argument('-n', dest='paths', default='1,2,3',
+                        help='comma separated path lengths')
+    parser.add_argument('-m', dest='maxpaths', default=10000, type=int,
+                        help='largest mesh to enumerate paths on')
+    parser.add_argument('-l', dest='lattices', default='100x100,200x200,400x400',
+                        help='comma separated synthetic lattice sizes')
+    parser.add_argument('-c', dest='compare', default=None,
+                        help='baseline results to compare against')
+    parser.add_argument('-t', dest='threshold', default=1.25, type=float,
+                        help='slowdown ratio counted as a regression')
+    parser.add_argument('--startup', dest='startup', action='store_true',
+                        help='only check the startup time of each command')
+    parser.add_argument('--budget', dest='budget', default=0.3, type=float,
+                        help='seconds each command may take to start')
+    parser.add_argument('input', nargs='*', help='mesh files, data/*.vtu by default')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s %(message)s',
+        level=logging.INFO
+    )
+
+    if args.startup:
+        results = startup(entrypoints, args.repeat)
+        with open(args.output, "w") as fp:
+            json.dump({
+                "version": __version__,
+                "python": platform.python_version(),
+                "startup": results,
+            }, fp, indent=1)
+        if checkstartup(results, args.budget):
+            sys.exit(1)
+        return
+
+    inputs = args.input or sorted(glob(path.join("data", "*.vtu")),
+                                  key=path.getsize)
+    lattices = ["lattice:%s" % l for l in args.lattices.split(",") if l]
+    stagenames = [s for s in args.stages.split(",") if s]
+    pathlengths = [int(n) for n in args.paths.split(",") if n]
+
+    results = run(inputs + lattices, stagenames, pathlengths, args.repeat,
+                  args.maxpaths)
+    with open(args.output, "w") as fp:
+        json.dump({
+            "version": __version__,
+            "python": platform.python_version(),
+            "results": results,
+        }, fp, indent=1)
+
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)["results"]
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
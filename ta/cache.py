@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from os import path
+import numpy as np
+
+from ta.db import signature, unchanged
+from ta.mesh import DictMesh, TissueGridException, prime, readmesh
+
+log = logging.getLogger("cache")
+
+## arrays kept for every cached mesh, the last two only if it has polygons
+arrays = ("types", "indptr", "indices", "offsets", "coords")
+
+class MeshCache(object):
+    """
+    An on-disk cache of the arrays that make up a mesh: cell types,
+    CSR adjacency and polygon geometry. Each entry is a directory of
+    .npy files that are memory mapped when loaded, so warm loads copy
+    almost nothing and worker processes share the mapped pages.
+
+    Entries are keyed by the source path and checked against its size,
+    mtime and fingerprint. Once the cache grows past limit bytes the
+    least recently used entries are removed.
+    """
+    def __init__(self, directory, limit=1 << 30):
+        self.directory = directory
+        self.limit = limit
+        if not path.isdir(directory):
+            os.makedirs(directory)
+
+    def _entry(self, filename, edges):
+        key = "%s:%s" % (path.abspath(filename), edges)
+        return path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def _valid(self, entry, filename):
+        try:
+            with open(path.join(entry, "meta.json")) as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return False
+        return unchanged(filename, meta["size"], meta["mtime"], meta["fingerprint"])
+
+    def _read(self, entry):
+        meta = path.join(entry, "meta.json")
+        os.utime(meta, None)
+        data = dict((name, np.load(path.join(entry, name + ".npy"), mmap_mode="r"))
+                    for name in arrays
+                    if path.exists(path.join(entry, name + ".npy")))
+        with open(meta) as fp:
+            data["topology"] = json.load(fp).get("topology")
+        return data
+
+    def _write(self, entry, filename, data):
+        size, mtime, fp = signature(filename)
+        meta = {
+            "topology": data["topology"],
+            "source": path.abspath(filename),
+            "size": size,
+            "mtime": mtime,
+            "fingerprint": fp,
+        }
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix=".tmp")
+        for name in arrays:
+            if data[name] is not None:
+                np.save(path.join(tmp, name + ".npy"), np.asarray(data[name]))
+        with open(path.join(tmp, "meta.json"), "w") as fp:
+            json.dump(meta, fp)
+        ## another process may have got there first, or the entry is stale
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=entry)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache is
+        within its limit, other than the entry keep
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            entry = path.join(self.directory, name)
+            meta = path.join(entry, "meta.json")
+            if name.startswith(".") or entry == keep or not path.exists(meta):
+                continue
+            size = sum(path.getsize(path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((path.getmtime(meta), size, entry))
+            total += size
+        entries.sort()
+        while total > self.limit and entries:
+            _, size, entry = entries.pop(0)
+            log.debug("evicting %s", entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def get(self, filename, load, edges=False):
+        """
+        Return the cached arrays for filename, calling load() to make
+        the mesh and caching its arrays if there is no valid entry
+        """
+        entry = self._entry(filename, edges)
+        if self._valid(entry, filename):
+            try:
+                return self._read(entry)
+            except EnvironmentError:
+                ## evicted by another process since it was checked
+                pass
+        mesh = load()
+        indptr, indices = mesh.neighbourIndex
+        try:
+            offsets, coords = mesh.geometry
+        except TissueGridException:
+            offsets = coords = None
+        data = {
+            "types": mesh.types,
+            "indptr": indptr,
+            "indices": indices,
+            "offsets": offsets,
+            "coords": coords,
+            "topology": mesh.topology,
+        }
+        self._write(entry, filename, data)
+        try:
+            return self._read(entry)
+        except EnvironmentError:
+            log.debug("%s was evicted before it could be read", entry)
+            return dict((k, v) for k, v in data.items() if v is not None)
+
+def _adjacencies(data):
+    from scipy.sparse import csr_matrix
+    n = len(data["types"])
+    return csr_matrix((np.ones(len(data["indices"]), dtype=bool),
+                       data["indices"], data["indptr"]), shape=(n, n))
+
+def _prime(mesh, data):
+    prime(mesh,
+          topology=data["topology"],
+          types=data["types"],
+          adjacencies=_adjacencies(data),
+          neighbourIndex=(data["indptr"], data["indices"]),
+          geometry=(data["offsets"], data["coords"]))
+    return mesh
+
+def default_cache():
+    """
+    The cache named by the TA_CACHE environment variable, limited to
+    TA_CACHE_SIZE megabytes, or None if caching is not configured
+    """
+    directory = os.environ.get("TA_CACHE")
+    if not directory:
+        return None
+    limit = int(os.environ.get("TA_CACHE_SIZE", 1024)) << 20
+    return MeshCache(directory, limit)
+
+def load(filename, format=None, edges=False, cache=None):
+    """
+    Load a mesh from a VTU, JSON or binary mesh file, through the
+    cache if there is one
+    """
+    if format is None:
+        format = "vtu" if filename.endswith(".vtu") else "json"
+    if cache is None:
+        cache = default_cache()
+
+    if format.lower() == "vtu":
+        from ta.vtu import VtuMesh
+        if cache is None:
+            return VtuMesh(filename, edges=edges)
+        data = cache.get(filename, lambda: VtuMesh(filename, edges=edges), edges)
+        return _prime(VtuMesh(filename, edges=edges), data)
+
+    if cache is None:
+        return readmesh(filename)
+    data = cache.get(filename, lambda: readmesh(filename))
+    n = len(data["types"])
+    mesh = DictMesh({
+        "types": data["types"],
+        "shape": (n, n),
+        "adjacencies": _adjacencies(data),
+    })
+    prime(mesh, neighbourIndex=(data["indptr"], data["indices"]))
+    if "offsets" in data:
+        prime(mesh, geometry=(data["offsets"], data["coords"]))
+    return mesh
@@ -1,4 +1,5 @@
 import logging
+import numpy as np
 
 log = logging.getLogger("clusters")
 
@@ -11,44 +12,57 @@ class Cluster(object):
     def __len__(self):
         return len(self.members)
 
-def _explore_cluster(mesh, i, seen = None, ctype = None):
+def _same_type_graph(mesh):
     """
-    Utility function that does a depth-first search to find
-    the set of cells with the same type as the i-th cell
+    Utility function that keeps only the adjacency edges that join
+    cells of the same type
     """
-    if seen is None:
-        seen = set()
-    if ctype is None:
-        ctype = mesh.types[i]
-    if i in seen:
-        return seen
-    if mesh.types[i] == ctype:
-        seen.add(i)
-        for n in mesh.neighbours(i):
-            new = _explore_cluster(mesh, n, seen, ctype)
-            seen = seen.union(new)
-    return seen
+    from scipy.sparse import csr_matrix
+    indptr, indices = mesh.neighbourIndex
+    types = np.asarray(mesh.types)
+    n = len(indptr) - 1
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    keep = types[rows] == types[indices]
+    data = np.ones(np.count_nonzero(keep), dtype=bool)
+    return csr_matrix((data, (rows[keep], indices[keep])), shape=(n, n))
+
+def labels(mesh):
+    """
+    returns the number of clusters and an array giving, for each
+    cell, the index of the cluster it belongs to
+    """
+    from scipy.sparse.csgraph import connected_components
+    return connected_components(_same_type_graph(mesh), directed=False)
 
 def clusters(mesh):
     """
     returns a list of all clusters in the mesh
     """
+    nclusters, cl = labels(mesh)
+    order = np.argsort(cl, kind="mergesort")
+    bounds = np.searchsorted(cl[order], np.arange(nclusters + 1))
+    types = np.asarray(mesh.types)
     clusters = []
-    seen = set()
-    for i in range(len(mesh)):
-        if i in seen: continue
-        members = _explore_cluster(mesh, i)
-        seen = seen.union(members)
-        clusters.append(Cluster(mesh.types[i], members))
+    for k in range(nclusters):
+        members = order[bounds[k]:bounds[k+1]]
+        clusters.append(Cluster(types[members[0]], members))
     return clusters
 
-def clusterstats(db, m):
+def clustersummary(m):
+    """
+    Calculate the (type, size) of every cluster in the mesh
+    """
     log.info("calculating cluster stats %s", m)
-    mid = db.meshfile(m.filename)
+    return [(c.ctype, len(c)) for c in clusters(m)]
+
+def saveclusterstats(db, filename, summary):
+    mid = db.meshfile(filename)
     cur = db.conn.cursor()
     cur.execute("DELETE FROM clusters WHERE mesh=?", (mid,))
-    for c in clusters(m):
-        cur.execute(
-            "INSERT INTO clusters(mesh, type, size) VALUES(?, ?, ?)",
-            (mid, c.ctype, len(c))
-        )
+    cur.executemany(
+        "INSERT INTO clusters(mesh, type, size) VALUES(?, ?, ?)",
+        ((mid, ctype, size) for ctype, size in summary)
+    )
+
+def clusterstats(db, m):
+    saveclusterstats(db, m.filename, clustersummary(m))
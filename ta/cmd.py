@@ -1,47 +1,296 @@
-from ta.mesh import VtuMesh
-from ta.db import Database
+from ta.cache import load
+from ta.db import Database, signature
 import os
 from os import path
 import logging
 import argparse
-import sys, traceback
+import time, traceback
+from functools import partial
+from itertools import imap
+from multiprocessing import Pool
+from Queue import Queue
+from threading import Thread
 
-from mesh import meshstats
-from clusters import clusterstats
+from mesh import meshsummary, savemeshstats, timestep
+from clusters import clustersummary, saveclusterstats
+from timing import Slowest, TimingLog, cells, measure, report, savetimings, stage
 
 log = logging.getLogger("tstats")
 
+def vtufiles(vtudir):
+    """
+    All VTU files under vtudir, with the timesteps of each simulation
+    in order so that consecutive ones can share their topology
+    """
+    for d, _, fs in os.walk(vtudir):
+        for fn in sorted(fs, key=timestep):
+            if fn.endswith(".vtu"):
+                yield path.join(d, fn)
+
+def _read(filename, edges, prefetch=False):
+    with stage("signature"):
+        sig = signature(filename)
+    with stage("load"):
+        m = load(filename, "vtu", edges=edges)
+        if prefetch:
+            ## decode now rather than when the statistics need it,
+            ## the topology needs the connectivity unless it was cached
+            m.types
+            m.topology
+            cells(len(m))
+    return sig, m
+
+def _summarise(m, meshstats, clusterstats):
+    mstats = cstats = None
+    if meshstats:
+        with stage("meshstats"):
+            mstats = meshsummary(m)
+    if clusterstats:
+        with stage("clusterstats"):
+            cstats = clustersummary(m)
+    cells(len(m))
+    return mstats, cstats
+
+def _analyse(filename, meshstats, clusterstats, edges):
+    sig, m = _read(filename, edges)
+    return (sig,) + _summarise(m, meshstats, clusterstats)
+
+def analyse(filename, meshstats=False, clusterstats=False, edges=False,
+            timed=False, profile=None):
+    """
+    Load one mesh and calculate the requested statistics. Only plain
+    values are returned so that this can run in a worker process, and
+    errors are returned as a formatted traceback rather than raised.
+
+    With timed set, the time and memory use of each stage are returned
+    as a list of timing records, otherwise None. If profile names a
+    directory the work is also profiled, and the profile saved there.
+    """
+    work = lambda: _analyse(filename, meshstats, clusterstats, edges)
+    try:
+        if not timed and profile is None:
+            return (filename,) + work() + (None, None)
+        (sig, mstats, cstats), timings = measure(filename, work, profile)
+        return filename, sig, mstats, cstats, timings.rows(), None
+    except Exception:
+        return filename, None, None, None, None, traceback.format_exc()
+
+def pipeline(files, depth, meshstats=False, clusterstats=False, edges=False,
+             timed=False, profile=None):
+    """
+    Analyse files in overlapping stages, giving the same results as
+    analyse() does for each. One thread reads and decodes meshes, at
+    most depth files ahead, and another calculates their statistics,
+    while the caller writes the results as they are yielded. The
+    throughput is then that of the slowest stage rather than of all
+    of them together. Only the statistics stage is profiled.
+    """
+    loaded = Queue(depth)
+    analysed = Queue(depth)
+
+    def read():
+        try:
+            for filename in files:
+                work = lambda: _read(filename, edges, prefetch=True)
+                try:
+                    if timed:
+                        (sig, m), timings = measure(filename, work, name="read")
+                        rows = timings.rows()
+                    else:
+                        (sig, m), rows = work(), None
+                    loaded.put((filename, sig, m, rows, None))
+                except Exception:
+                    loaded.put((filename, None, None, None, traceback.format_exc()))
+        finally:
+            loaded.put(None)
+
+    def summarise():
+        try:
+            for filename, sig, m, rows, error in iter(loaded.get, None):
+                if error is not None:
+                    analysed.put((filename, None, None, None, None, error))
+                    continue
+                work = lambda: _summarise(m, meshstats, clusterstats)
+                try:
+                    if timed or profile is not None:
+                        (mstats, cstats), timings = measure(filename, work,
+                                                            profile, "analyse")
+                        rows = (rows or []) + timings.rows()
+                    else:
+                        mstats, cstats = work()
+                    analysed.put((filename, sig, mstats, cstats, rows, None))
+                except Exception:
+                    analysed.put((filename, None, None, None, None,
+                                  traceback.format_exc()))
+        finally:
+            analysed.put(None)
+
+    for target in (read, summarise):
+        thread = Thread(target=target, name=target.__name__)
+        thread.daemon = True
+        thread.start()
+    return iter(analysed.get, None)
+
+def _failed(filename, tb):
+    log.error("error processing %s:", filename)
+    for s in tb.splitlines(True):
+        log.error(s)
+
+def statname(name, edges=False):
+    """
+    The name statistics are recorded under, which includes the
+    adjacency they were calculated with
+    """
+    return name + ":edges" if edges else name
+
+def store(db, results, edges=False):
+    """
+    Write a batch of results in a single transaction. If one of them
+    cannot be written it is logged and rolled back, and the rest of
+    the batch is written again without it.
+    """
+    pending = list(results)
+    while pending:
+        done = 0
+        try:
+            for filename, sig, mstats, cstats in pending:
+                stats = []
+                if mstats is not None:
+                    savemeshstats(db, filename, mstats)
+                    stats.append(statname("meshstats", edges))
+                if cstats is not None:
+                    saveclusterstats(db, filename, cstats)
+                    stats.append(statname("clusterstats", edges))
+                db.record(filename, sig, stats)
+                done += 1
+            db.conn.commit()
+            return
+        except Exception:
+            db.conn.rollback()
+            _failed(pending[done][0], traceback.format_exc())
+            del pending[done]
+
 def main():
     parser = argparse.ArgumentParser(prog='tstats')
     parser.add_argument('-d', dest='db', help='Database File')
+    parser.add_argument('-j', dest='jobs', default=1, type=int,
+                        help='number of worker processes')
+    parser.add_argument('-b', dest='batch', default=None, type=int,
+                        help='files per database commit')
     parser.add_argument('--meshstats', dest='meshstats', action='store_true')
     parser.add_argument('--clusterstats', dest='clusterstats', action='store_true')
+    parser.add_argument('-p', dest='prefetch', default=0, type=int,
+                        help='read this many files ahead of the statistics in a '
+                        'separate thread, with -j 1')
+    parser.add_argument('--edges', dest='edges', action='store_true',
+                        help='cells are adjacent only if they share an edge')
+    parser.add_argument('--bulk', dest='bulk', action='store_true',
+                        help='use write-ahead logging for faster loading')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='recalculate files whose statistics are up to date')
+    parser.add_argument('--timings', dest='timings', action='store_true',
+                        help='record the time taken by each stage in the database')
+    parser.add_argument('--timings-log', dest='timingslog', default=None,
+                        help='append the time taken by each stage to this file as JSON lines')
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help='directory to save profiles of the slowest files to')
+    parser.add_argument('--profile-count', dest='profilecount', default=5, type=int,
+                        help='number of slowest files to keep profiles of')
     parser.add_argument('vtudir', help='VTU data directory')
     logging.basicConfig(
         format='%(asctime)s %(levelname)s %(message)s',
         level=logging.DEBUG
     )
     args = parser.parse_args()
+    if args.prefetch and args.jobs > 1:
+        parser.error('-p cannot be combined with -j')
+    batchsize = args.batch
+    if batchsize is None:
+        if args.jobs > 1:
+            batchsize = 4 * args.jobs
+        elif args.prefetch:
+            batchsize = 4 * args.prefetch
+        else:
+            batchsize = 1
 
-    db = Database(args.db)
+    db = Database(args.db, bulk=args.bulk)
 
-    for d, _, fs in os.walk(args.vtudir):
-        for fn in fs:
-            if fn.endswith(".vtu"):
-                filename = path.join(d, fn)
-                try:
-                    m = VtuMesh(filename)
-                    if args.meshstats:
-                        meshstats(db, m)
-                    if args.clusterstats:
-                        clusterstats(db, m)
-                    db.conn.commit()
-                except Exception:
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    log.error("error processing %s:", filename)
-                    for s in traceback.format_exception(exc_type, exc_value, exc_traceback):
-                        log.error(s)
-                    db.conn.rollback()
+    timed = args.timings or args.timingslog is not None
+    run = time.strftime("%Y-%m-%dT%H:%M:%S")
+    timinglog = TimingLog(args.timingslog) if args.timingslog else None
+    slowest = None
+    if args.profile is not None:
+        slowest = Slowest(args.profile, args.profilecount)
+
+    work = partial(analyse, meshstats=args.meshstats,
+                   clusterstats=args.clusterstats, edges=args.edges,
+                   timed=timed, profile=args.profile)
+    wanted = [statname(name, args.edges) for name in ("meshstats", "clusterstats")
+              if getattr(args, name)]
+    files = []
+    for filename in vtufiles(args.vtudir):
+        if not args.force and db.uptodate(filename, wanted):
+            log.debug("skipping unchanged %s", filename)
+            continue
+        files.append(filename)
+    pool = None
+    if args.prefetch:
+        results = pipeline(files, args.prefetch, meshstats=args.meshstats,
+                           clusterstats=args.clusterstats, edges=args.edges,
+                           timed=timed, profile=args.profile)
+    elif args.jobs > 1:
+        pool = Pool(args.jobs)
+        ## runs of consecutive timesteps go to the same worker
+        chunksize = max(1, min(16, len(files) // (4 * args.jobs)))
+        results = pool.imap_unordered(work, files, chunksize)
+    else:
+        results = imap(work, files)
+
+    alltimings = []
+    def flush(batch, timings):
+        if not batch:
+            return
+        start = time.time()
+        store(db, batch, args.edges)
+        if not timed:
+            return
+        timings.append({
+            "file": None, "stage": "commit", "depth": 0, "start": None,
+            "seconds": time.time() - start,
+            "cells": sum(dict((r["file"], r["cells"] or 0) for r in timings).values()),
+            "rss_kb": None, "peak_kb": None,
+        })
+        if args.timings:
+            savetimings(db, run, timings)
+            db.conn.commit()
+        if timinglog is not None:
+            timinglog.write(timings)
+        alltimings.extend(timings)
+
+    batch = []
+    timings = []
+    for filename, sig, mstats, cstats, rows, error in results:
+        if error is not None:
+            _failed(filename, error)
+            continue
+        batch.append((filename, sig, mstats, cstats))
+        if rows is not None:
+            timings.extend(rows)
+            if slowest is not None:
+                slowest.add(filename, sum(r["seconds"] for r in rows if r["depth"] == 0))
+        if len(batch) >= batchsize:
+            flush(batch, timings)
+            batch = []
+            timings = []
+    flush(batch, timings)
+    if timed:
+        report(alltimings)
+    if timinglog is not None:
+        timinglog.close()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 def entropy():
     parser = argparse.ArgumentParser(prog='pentropy')
@@ -1,7 +1,10 @@
 import sqlite3
+import hashlib
 import logging
+import os
 import re
 from os import path
+from ta import __version__
 log = logging.getLogger("db")
 
 tables = {
@@ -12,7 +15,12 @@ tables = {
             name VARCHAR,
             time VARCHAR,
             size INTEGER,
-            entropy DOUBLE
+            entropy DOUBLE,
+            filesize INTEGER,
+            mtime DOUBLE,
+            fingerprint VARCHAR,
+            stats VARCHAR,
+            version VARCHAR
         );
     """,
     "clusters": """
@@ -22,21 +30,102 @@ tables = {
             size INTEGER
         )
     """,
+    "timings": """
+        CREATE TABLE timings (
+            run VARCHAR,
+            file VARCHAR,
+            stage VARCHAR,
+            depth INTEGER,
+            seconds DOUBLE,
+            cells INTEGER,
+            rss INTEGER,
+            peak INTEGER
+        )
+    """,
+}
+
+## columns added to tables after they were first created, so that
+## existing databases can be brought up to date
+columns = {
+    "meshfiles": [
+        ("filesize", "INTEGER"),
+        ("mtime", "DOUBLE"),
+        ("fingerprint", "VARCHAR"),
+        ("stats", "VARCHAR"),
+        ("version", "VARCHAR"),
+    ],
 }
 
+indexes = {
+    "meshfiles_file": "CREATE INDEX IF NOT EXISTS meshfiles_file ON meshfiles(file)",
+    "clusters_mesh": "CREATE INDEX IF NOT EXISTS clusters_mesh ON clusters(mesh)",
+}
+
+def fingerprint(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def signature(filename):
+    """
+    The (size, mtime, fingerprint) of a file, used to tell whether
+    stored statistics are still valid for it
+    """
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime, fingerprint(filename))
+
+def unchanged(filename, size, mtime, fp):
+    """
+    True if the file still has the signature (size, mtime, fp). The
+    contents are only fingerprinted if the size is the same but the
+    mtime is not, as when a file has been touched or copied.
+    """
+    st = os.stat(filename)
+    if st.st_size != size:
+        return False
+    return st.st_mtime == mtime or fingerprint(filename) == fp
+
 class Database(object):
-    def __init__(self, dbfile):
+    ## the schema, which subclasses may replace
+    tables = tables
+    columns = columns
+    indexes = indexes
+
+    def __init__(self, dbfile, bulk=False):
+        """
+        With bulk set, the database is put in write-ahead-log mode and
+        does not sync on every commit, which makes loading large
+        amounts of data much faster. WAL does not work on network
+        filesystems, so this is not the default.
+        """
         self.conn = sqlite3.connect(dbfile)
+        if bulk:
+            cur = self.conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
         self.init_schema()
 
     def init_schema(self):
-        for name, create in tables.items():
+        for name, create in self.tables.items():
             cur = self.conn.cursor()
             try:
                 cur.execute("SELECT * FROM %s" % name)
             except sqlite3.OperationalError:
                 log.info("creating table %s", name)
                 cur.execute(create)
+        for name, cols in self.columns.items():
+            cur = self.conn.cursor()
+            cur.execute("PRAGMA table_info(%s)" % name)
+            have = set(row[1] for row in cur.fetchall())
+            for col, coltype in cols:
+                if col not in have:
+                    log.info("adding column %s.%s", name, col)
+                    cur.execute("ALTER TABLE %s ADD COLUMN %s %s" % (name, col, coltype))
+        for name, create in self.indexes.items():
+            cur = self.conn.cursor()
+            cur.execute(create)
         self.conn.commit()
 
     def meshfile(self, filename):
@@ -49,6 +138,57 @@ class Database(object):
                 "INSERT INTO meshfiles(file, name) VALUES(?, ?);",
                 (filename, basename)
             )
-            cur.execute("SELECT id FROM meshfiles WHERE file=?;", (filename,))
-            row = cur.fetchone()
+            return cur.lastrowid
         return row[0]
+
+    def uptodate(self, filename, stats):
+        """
+        True if the statistics stored for the file include all of
+        stats, in the same mode, and were calculated by this version
+        of the code from the same file contents
+        """
+        cur = self.conn.cursor()
+        cur.execute("""
+        SELECT id, filesize, mtime, fingerprint, stats, version
+        FROM meshfiles WHERE file=?
+        """, (filename,))
+        row = cur.fetchone()
+        if row is None or row[4] is None:
+            return False
+        mid, filesize, mtime, fp, stored, version = row
+        if version != __version__ or not set(stats) <= set(stored.split(",")):
+            return False
+        if not unchanged(filename, filesize, mtime, fp):
+            return False
+        current = path.getmtime(filename)
+        if current != mtime:
+            ## touched but unchanged, remember the new mtime
+            cur.execute("UPDATE meshfiles SET mtime=? WHERE id=?", (current, mid))
+            self.conn.commit()
+        return True
+
+    def record(self, filename, sig, stats):
+        """
+        Record the signature of the file that the stored statistics
+        were calculated from, and which statistics they were. Names
+        may carry the mode they were calculated in after a colon, as
+        in meshstats:edges, and statistics stored in another mode are
+        forgotten since they have been overwritten.
+        """
+        mid = self.meshfile(filename)
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT fingerprint, stats, version FROM meshfiles WHERE id=?",
+            (mid,)
+        )
+        fp, stored, version = cur.fetchone()
+        stats = set(stats)
+        if stored and fp == sig[2] and version == __version__:
+            replaced = set(s.split(":")[0] for s in stats)
+            stats.update(s for s in stored.split(",")
+                         if s.split(":")[0] not in replaced)
+        cur.execute("""
+        UPDATE meshfiles
+        SET filesize=?, mtime=?, fingerprint=?, stats=?, version=?
+        WHERE id=?
+        """, tuple(sig) + (",".join(sorted(stats)), __version__, mid))
@@ -1,8 +1,19 @@
 import argparse
-from mesh import VtuMesh, DictMesh
+import hashlib
 import json
+import logging
+import os
+import tempfile
+from os import path
+from cache import load
+from db import signature, unchanged
+from mesh import mklattice, topologies
+from timing import Slowest, TimingLog, cells, measure, report, stage
+import numpy as np
 from math import log
 
+logger = logging.getLogger("entropy")
+
 def paths(mesh, n):
     def _paths(c, l, head):
         if l == 0:
@@ -26,6 +37,9 @@ def distribution(mesh, ps):
     Xmap = {}
     for p in [colour(mesh, p) for p in ps]:
         Xmap[p] = Xmap.get(p, 0) + 1
+    return normalise(Xmap)
+
+def normalise(Xmap):
     total = sum(Xmap.values())
     def prob(x):
         return float(x)/total
@@ -34,49 +48,562 @@ def distribution(mesh, ps):
         dist[k] = prob(v)
     return dist
 
+def _expand(indptr, indices, cells):
+    """
+    Utility function that lists the neighbours of each of the given
+    cells, returning the position in cells that each row came from
+    and the neighbour itself
+    """
+    degree = indptr[cells + 1] - indptr[cells]
+    rows = np.repeat(np.arange(len(cells)), degree)
+    first = np.repeat(np.cumsum(degree) - degree, degree)
+    pos = np.repeat(indptr[cells], degree) + np.arange(len(rows)) - first
+    return rows, indices[pos]
+
+def _selfavoiding(mesh, n, codes, k, budget=1000000):
+    """
+    Count self-avoiding paths of each length up to n by colour
+    sequence code. The paths are still enumerated, but as arrays, a
+    batch of start cells at a time, so the work is exponential in n.
+    Batches are sized so that at most about budget paths are held at
+    once, from the largest degree in the mesh, but a single start cell
+    can exceed that for long paths.
+    """
+    indptr, indices = mesh.neighbourIndex
+    degree = int(np.diff(indptr).max()) if len(mesh) else 0
+    ## the most paths of length n from one start cell
+    fanout = max(1, degree) * max(1, degree - 1) ** max(0, n - 1)
+    batch = max(1, budget // fanout)
+    result = [{} for _ in range(n + 1)]
+    for start in range(0, len(mesh), batch):
+        walks = np.arange(start, min(len(mesh), start + batch))[:, None]
+        seq = codes[walks[:,0]]
+        for length in range(1, n + 1):
+            rows, nxt = _expand(indptr, indices, walks[:,-1])
+            ok = (walks[rows] != nxt[:, None]).all(axis=1)
+            rows, nxt = rows[ok], nxt[ok]
+            walks = np.column_stack((walks[rows], nxt))
+            seq = seq[rows] * k + codes[nxt]
+            bylength = result[length]
+            for code, count in zip(*np.unique(seq, return_counts=True)):
+                bylength[code] = bylength.get(code, 0) + count
+    return result
+
+def _nonbacktracking(mesh, n, codes, k):
+    """
+    Count non-backtracking walks of each length up to n by colour
+    sequence code with a transfer matrix over directed edges. Walks are never listed, for
+    each colour prefix only the number of walks ending on each edge is
+    kept, and prefixes are extended depth-first.
+    """
+    indptr, indices = mesh.neighbourIndex
+    src = np.repeat(np.arange(len(mesh)), np.diff(indptr))
+    dst = indices
+    nedges = len(dst)
+
+    # edge e = (u, v) continues into f = (v, w) unless w == u
+    def build():
+        from scipy.sparse import csr_matrix
+        rows, f = _expand(indptr, np.arange(nedges), dst)
+        keep = dst[f] != src[rows]
+        data = np.ones(np.count_nonzero(keep), dtype=np.int64)
+        return csr_matrix((data, (f[keep], rows[keep])), shape=(nedges, nedges))
+    transfer = topologies.get(mesh.topology, "transfer", build)
+
+    # the states are edges, coloured by the cell they point to
+    ecodes = codes[dst]
+    members = [np.flatnonzero(ecodes == a) for a in range(k)]
+    step = [[transfer[members[b]][:, members[a]] for b in range(k)]
+            for a in range(k)]
+    last = [np.array([np.asarray(step[a][b].sum(axis=0)).ravel()
+                      for b in range(k)]) for a in range(k)]
+
+    stack = []
+    for b in range(k):
+        for a in range(k):
+            start = (codes[src[members[b]]] == a).astype(np.int64)
+            if start.any():
+                stack.append((a*k + b, n - 1, b, start))
+
+    result = [{} for _ in range(n + 1)]
+    while stack:
+        code, remaining, a, counts = stack.pop()
+        result[n - remaining][code] = counts.sum()
+        if remaining == 1:
+            for b, c in enumerate(last[a].dot(counts)):
+                if c: result[n][code*k + b] = c
+        elif remaining > 1:
+            for b in range(k):
+                nxt = step[a][b].dot(counts)
+                if nxt.any():
+                    stack.append((code*k + b, remaining - 1, b, nxt))
+    return result
+
+walk_kinds = {
+    "selfavoiding": _selfavoiding,
+    "nonbacktracking": _nonbacktracking,
+}
+
+def _colours(code, values, n):
+    """
+    Utility function that turns a colour sequence code back into a
+    tuple of cell types
+    """
+    k = len(values)
+    digits = []
+    for _ in range(n + 1):
+        code, d = divmod(code, k)
+        digits.append(values[d])
+    return tuple(reversed(digits))
+
+def _decode(bycode, values, n):
+    return dict((_colours(code, values, n), int(count))
+                for code, count in bycode.items())
+
+def series(mesh, n, walks="selfavoiding"):
+    """
+    Count the paths of every length from 1 to n by colour sequence in
+    a single pass, each length extending the counts of the one before.
+    Returns a list of dictionaries like the one counts() returns.
+    """
+    values, codes = mesh.typeIndex
+    bylength = walk_kinds[walks](mesh, n, codes, len(values))
+    return [_decode(bylength[l], values, l) for l in range(1, n + 1)]
+
+def counts(mesh, n, walks="selfavoiding"):
+    """
+    Count the paths of length n in the mesh by colour sequence
+    without listing them one at a time. The result is a dictionary
+    like the one distribution() builds before normalising.
+    """
+    if n == 0:
+        values, codes = mesh.typeIndex
+        return _decode(dict(enumerate(np.bincount(codes))), values, 0)
+    return series(mesh, n, walks)[-1]
+
+def _sample(mesh, n, codes, k, samples, rng):
+    """
+    Grow random self-avoiding walks from uniformly chosen start cells,
+    each step choosing uniformly among the unvisited neighbours. Returns
+    the colour sequence code of each walk and its Rosenbluth weight, an
+    unbiased estimate of the number of paths it stands for, which is
+    zero for walks that got trapped
+    """
+    indptr, indices = mesh.neighbourIndex
+    walks = rng.randint(len(mesh), size=samples)[:, None]
+    seq = codes[walks[:,0]]
+    weights = np.empty(samples)
+    weights.fill(len(mesh))
+    for _ in range(n):
+        rows, nxt = _expand(indptr, indices, walks[:,-1])
+        ok = (walks[rows] != nxt[:, None]).all(axis=1)
+        rows, nxt = rows[ok], nxt[ok]
+        choices = np.bincount(rows, minlength=samples)
+        weights *= choices
+        alive = choices > 0
+        first = np.cumsum(choices) - choices
+        pick = first + (rng.random_sample(samples) * choices).astype(np.int64)
+        step = np.zeros(samples, dtype=np.int64)
+        step[alive] = nxt[pick[alive]]
+        walks = np.column_stack((walks, step))
+        seq = seq * k + codes[step]
+    return seq, weights
+
+def estimate(mesh, n, samples=10000, seed=None, bootstrap=200,
+             confidence=0.95, stat=None):
+    """
+    Estimate the colour path distribution of self-avoiding paths of
+    length n from a fixed budget of sampled walks, along with a
+    statistic of it (entropy unless stat is given) and a bootstrap
+    confidence interval for that statistic. Returns the tuple
+    (dist, value, (low, high)), with no interval if bootstrap is zero.
+
+    The plug-in entropy of a sample is biased low, since it misses
+    rare colour sequences, and resampling misses even more of them,
+    so the value is corrected by the bootstrap estimate of that bias
+    and the interval is the basic (reflected percentile) one. On the
+    bundled meshes with n up to 5, 95% intervals covered the exact
+    value in about 90% of runs once at least 97% of the sampled walks
+    had a colour sequence seen more than once, and a warning is logged
+    when fewer have. Below that the value is still low and the
+    interval too narrow, so more samples are needed.
+    """
+    if stat is None:
+        stat = entropy
+    rng = np.random.RandomState(seed)
+    values, codes = mesh.typeIndex
+    seq, weights = _sample(mesh, n, codes, len(values), samples, rng)
+    found, which = np.unique(seq, return_inverse=True)
+    keys = [_colours(code, values, n) for code in found]
+
+    def dist_of(idx):
+        w = np.bincount(which[idx], weights=weights[idx], minlength=len(found))
+        total = w.sum()
+        return dict((keys[i], w[i] / total) for i in np.flatnonzero(w))
+
+    dist = dist_of(np.arange(samples))
+    value = stat(dist)
+    replicates = [stat(dist_of(rng.randint(samples, size=samples)))
+                  for _ in range(bootstrap)]
+    if not replicates:
+        return dist, value, None
+
+    ## Good-Turing estimate of how much of the distribution was seen
+    seen = which[weights > 0]
+    if len(seen):
+        coverage = 1 - np.count_nonzero(np.bincount(seen) == 1) / float(len(seen))
+        if coverage < 0.97:
+            logger.warning("only %.1f%% of sampled paths were seen more than once, "
+                           "the estimate is biased low, use more samples",
+                           100 * coverage)
+    alpha = 100 * (1 - confidence) / 2
+    low, high = np.percentile(replicates, [alpha, 100 - alpha], axis=0)
+    bias = np.mean(replicates, axis=0) - value
+    return dist, value - bias, (2 * value - high, 2 * value - low)
+
 def entropy(dist):
     return -1 * sum(p * log(p, 2) for p in dist.values())
- 
-def relentropy(dist, rel):
-    keys = set(dist.keys()).union(rel.keys())
-    rent = 0.0
-    for k in keys:
-        p = dist.get(k, 0.0)
-        q = rel.get(k, 0.0)
-        rent += p * log(p/q, 2)
-    return rent
+
+## how to treat colour paths that the reference distribution lacks
+smoothing_rules = ("none", "epsilon", "skip")
+
+def _relentropy(p, q, smoothing="none", epsilon=1e-6):
+    """
+    Utility function for the relative entropy of the probabilities p
+    against q, aligned by colour path. Paths the reference lacks have
+    q == 0. With no smoothing they make the relative entropy infinite,
+    with epsilon they are given that probability, the reference being
+    scaled down to make room, and with skip they are left out and both
+    distributions renormalised over the paths they share.
+    """
+    missing = (q == 0) & (p > 0)
+    if missing.any():
+        if smoothing == "none":
+            return float("inf")
+        if smoothing == "epsilon":
+            q = np.where(missing, epsilon, q) / (1 + epsilon * missing.sum())
+        elif smoothing == "skip":
+            p, q = p[~missing], q[~missing]
+            if not p.sum():
+                return float("inf")
+            p, q = p / p.sum(), q / q.sum()
+        else:
+            raise ValueError("unknown smoothing rule %s" % smoothing)
+    keep = p > 0
+    return float((p[keep] * np.log2(p[keep] / q[keep])).sum())
+
+def relentropy(dist, rel, smoothing="none", epsilon=1e-6):
+    keys = list(dist.keys())
+    p = np.array([dist[k] for k in keys], dtype=float)
+    q = np.array([rel.get(k, 0.0) for k in keys], dtype=float)
+    return _relentropy(p, q, smoothing, epsilon)
+
+class Reference(object):
+    """
+    The colour path distribution of a reference mesh for one path
+    length, as the sorted colour sequence codes of its paths (see
+    _colours) and their probabilities, so that a distribution can be
+    looked up against it in one vectorised search
+    """
+    def __init__(self, values, codes, probs, n):
+        self.values = np.asarray(values, dtype=float)
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.probs = np.asarray(probs, dtype=float)
+        self.n = n
+
+    def __len__(self):
+        return len(self.codes)
+
+    def lookup(self, keys):
+        """
+        The reference probability of each colour path in keys, an
+        array with a row of cell types for each path
+        """
+        k = len(self.values)
+        keys = np.asarray(keys, dtype=float).reshape(-1, self.n + 1)
+        digits = np.searchsorted(self.values, keys).clip(0, max(0, k - 1))
+        known = (self.values[digits] == keys).all(axis=1)
+        codes = digits.dot(k ** np.arange(self.n, -1, -1, dtype=np.int64))
+        pos = np.searchsorted(self.codes, codes).clip(0, max(0, len(self) - 1))
+        found = known & (self.codes[pos] == codes)
+        return np.where(found, self.probs[pos], 0.0)
+
+    def relentropy(self, dist, smoothing="none", epsilon=1e-6):
+        keys = list(dist.keys())
+        p = np.array([dist[k] for k in keys], dtype=float)
+        return _relentropy(p, self.lookup(keys), smoothing, epsilon)
+
+    def distribution(self):
+        return dict((_colours(code, self.values, self.n), p)
+                    for code, p in zip(self.codes, self.probs))
+
+def references(mesh, n, walks="selfavoiding"):
+    """
+    The exact colour path distributions of the mesh for every path
+    length from 0 to n, as References
+    """
+    values, codes = mesh.typeIndex
+    bylength = [dict(enumerate(np.bincount(codes)))]
+    if n > 0:
+        bylength += walk_kinds[walks](mesh, n, codes, len(values))[1:]
+    result = []
+    for l, bycode in enumerate(bylength):
+        found = np.array(sorted(bycode), dtype=np.int64)
+        total = np.array([bycode[c] for c in found], dtype=float)
+        result.append(Reference(values, found, total / total.sum(), l))
+    return result
+
+def sampled_reference(mesh, n, samples=10000, seed=None):
+    """
+    The colour path distribution of the mesh for paths of length n,
+    estimated from the same sampled walks as estimate() with the same
+    seed, as a Reference
+    """
+    rng = np.random.RandomState(seed)
+    values, codes = mesh.typeIndex
+    seq, weights = _sample(mesh, n, codes, len(values), samples, rng)
+    found, which = np.unique(seq, return_inverse=True)
+    w = np.bincount(which, weights=weights, minlength=len(found))
+    keep = w > 0
+    return Reference(values, found[keep], w[keep] / w.sum(), n)
+
+def reference_mesh(spec):
+    """
+    Load a reference mesh, either a mesh file or a lattice given as
+    lattice:PATTERN:NxM or lattice:PATTERN:NxM:SEED
+    """
+    if spec.startswith("lattice:"):
+        parts = spec.split(":")
+        n, m = parts[2].split("x")
+        seed = int(parts[3]) if len(parts) > 3 else 0
+        return mklattice(int(n), int(m), parts[1], seed)
+    return load(spec)
+
+class ReferenceLibrary(object):
+    """
+    Reference colour path distributions, kept in memory and, if a
+    directory is given, saved there as .npz files so that they are
+    only ever calculated once. Entries for mesh files are checked
+    against the size, mtime and fingerprint of the file.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.memory = {}
+        if directory is not None and not path.isdir(directory):
+            os.makedirs(directory)
+
+    def _key(self, spec, n, walks):
+        if not spec.startswith("lattice:"):
+            spec = path.abspath(spec)
+        return "%s:%d:%s" % (spec, n, walks)
+
+    def _entry(self, key):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return path.join(self.directory, name + ".npz")
+
+    def _source(self, spec):
+        if spec.startswith("lattice:"):
+            return None
+        return list(signature(spec))
+
+    def _read(self, spec, n, walks):
+        key = self._key(spec, n, walks)
+        if key in self.memory or self.directory is None:
+            return self.memory.get(key)
+        try:
+            data = np.load(self._entry(key))
+        except IOError:
+            return None
+        source = json.loads(str(data["source"]))
+        if source is not None and not unchanged(spec, *source):
+            return None
+        ref = Reference(data["values"], data["codes"], data["probs"], n)
+        self.memory[key] = ref
+        return ref
+
+    def _write(self, spec, walks, refs):
+        source = json.dumps(self._source(spec)) if self.directory else None
+        for ref in refs:
+            key = self._key(spec, ref.n, walks)
+            self.memory[key] = ref
+            if self.directory is None:
+                continue
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp", suffix=".npz")
+            with os.fdopen(fd, "wb") as fp:
+                np.savez(fp, values=ref.values, codes=ref.codes, probs=ref.probs,
+                         source=np.array(source))
+            os.rename(tmp, self._entry(key))
+
+    def upto(self, spec, n, walks="selfavoiding"):
+        """
+        The References of the mesh for path lengths 0 to n,
+        calculating and saving them all if any is missing
+        """
+        refs = [self._read(spec, l, walks) for l in range(n + 1)]
+        if any(ref is None for ref in refs):
+            logger.info("calculating reference distributions of %s", spec)
+            refs = references(reference_mesh(spec), n, walks)
+            self._write(spec, walks, refs)
+        return refs
+
+    def get(self, spec, n, walks="selfavoiding"):
+        return self.upto(spec, n, walks)[n]
+
+    def sampled(self, spec, n, samples, seed=None):
+        """
+        The Reference of the mesh for path length n estimated from
+        sampled walks, kept apart from the exact ones by the number
+        of samples and the seed
+        """
+        walks = "sampled:%d:%s" % (samples, seed)
+        ref = self._read(spec, n, walks)
+        if ref is None:
+            logger.info("sampling reference distribution of %s", spec)
+            ref = sampled_reference(reference_mesh(spec), n, samples, seed)
+            self._write(spec, walks, [ref])
+        return ref
+
+def default_library():
+    """
+    The reference library in the directory named by the TA_REFERENCES
+    environment variable, or one kept only in memory
+    """
+    return ReferenceLibrary(os.environ.get("TA_REFERENCES") or None)
 
 def main():
     parser = argparse.ArgumentParser(prog='pentropy')
     parser.add_argument('-n', dest='number', default=1, type=int, help='Path entropy series term')
-    parser.add_argument('-r', dest='relative', default=None,
-                        help='reference for relative entropy')
+    parser.add_argument('-r', dest='relative', action='append', default=[],
+                        help='reference for relative entropy, a mesh file or '
+                        'lattice:PATTERN:NxM[:SEED], may be given more than once')
+    parser.add_argument('-R', dest='library', default=None,
+                        help='directory to keep reference distributions in')
+    parser.add_argument('-S', dest='smoothing', default='epsilon',
+                        choices=smoothing_rules,
+                        help='treatment of paths a reference lacks')
+    parser.add_argument('-e', dest='epsilon', default=1e-6, type=float,
+                        help='probability given to paths a reference lacks')
+    parser.add_argument('-c', dest='count', action='store_true', default=False,
+                        help='count paths by colour instead of listing them, '
+                        'self-avoiding paths are still enumerated so this is '
+                        'exponential in n, -w nonbacktracking is the mode for n '
+                        'of about 6 to 10')
+    parser.add_argument('-w', dest='walks', default='selfavoiding',
+                        choices=sorted(walk_kinds.keys()),
+                        help='walk semantics for counting mode')
+    parser.add_argument('-s', dest='series', action='store_true', default=False,
+                        help='compute every series term from 1 to n at once')
+    parser.add_argument('-m', dest='samples', default=None, type=int,
+                        help='estimate from this many sampled walks')
+    parser.add_argument('-b', dest='bootstrap', default=200, type=int,
+                        help='bootstrap replicates for sampled estimates')
+    parser.add_argument('--seed', dest='seed', default=None, type=int,
+                        help='random seed for sampled estimates')
+    parser.add_argument('--timings', dest='timings', default=None,
+                        help='append the time taken by each stage to this file as JSON lines')
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help='directory to save profiles of the slowest files to')
+    parser.add_argument('--profile-count', dest='profilecount', default=5, type=int,
+                        help='number of slowest files to keep profiles of')
     parser.add_argument('input', nargs='*', help='input files')
 
     args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s %(message)s',
+        level=logging.INFO if args.timings else logging.WARNING
+    )
+    if args.walks != 'selfavoiding' and not args.count:
+        parser.error('-w %s requires counting mode (-c)' % args.walks)
+    if args.samples is not None and (args.count or args.series):
+        parser.error('-m cannot be combined with -c or -s')
 
-    if args.relative is not None:
-        if args.relative.endswith('.vtu'):
-            rel = VtuMesh(args.relative)
-        else:
-            with open(args.relative) as fp:
-                data = json.loads(fp.read())
-            rel = DictMesh(data)
-        rdist = distribution(rel, paths(rel, args.number))
+    def dist_of(mesh):
+        if args.series:
+            return [normalise(c) for c in series(mesh, args.number, args.walks)]
+        if args.count:
+            return normalise(counts(mesh, args.number, args.walks))
+        return distribution(mesh, paths(mesh, args.number))
 
-    for infile in args.input:
-        if infile.endswith('.vtu'):
-            mesh = VtuMesh(infile)
-        else:
-            with open(infile) as fp:
-                data = json.loads(fp.read())
-            mesh = DictMesh(data)
+    if args.library is not None:
+        library = ReferenceLibrary(args.library)
+    else:
+        library = default_library()
+    if args.samples is not None:
+        ## estimated under the same budget, never enumerated exactly
+        refs = [library.sampled(spec, args.number, args.samples, args.seed)
+                for spec in args.relative]
+    else:
+        refs = [library.upto(spec, args.number, args.walks)
+                for spec in args.relative]
 
-        dist = distribution(mesh, paths(mesh, args.number))
+    def rel(dist, ref):
+        return ref.relentropy(dist, args.smoothing, args.epsilon)
 
-        if args.relative is not None:
-            print infile, relentropy(dist, rdist)
-        else:
-            print infile, entropy(dist)
+    def output(infile, results):
+        """
+        One line for the file, or one for each reference if there
+        are several
+        """
+        if len(results) == 1:
+            print infile, " ".join(str(float(v)) for v in results[0])
+            return
+        for spec, values in zip(args.relative, results):
+            print infile, spec, " ".join(str(float(v)) for v in values)
+
+    def process(infile):
+        with stage("load"):
+            mesh = load(infile)
+
+        if args.samples is not None:
+            if refs:
+                stat = lambda d: np.array([rel(d, r) for r in refs])
+            else:
+                stat = lambda d: np.array([entropy(d)])
+            with stage("estimate"):
+                _, value, interval = estimate(mesh, args.number, args.samples,
+                                              args.seed, args.bootstrap,
+                                              stat=stat)
+            cells(len(mesh))
+            if interval is None:
+                ## no bootstrap, so just the estimate
+                output(infile, zip(value))
+            else:
+                output(infile, zip(value, *interval))
+            return
+
+        with stage("distribution"):
+            dist = dist_of(mesh)
+        cells(len(mesh))
 
+        with stage("result"):
+            if args.series:
+                if refs:
+                    results = [[rel(d, r) for d, r in zip(dist, ref[1:])]
+                               for ref in refs]
+                else:
+                    results = [[entropy(d) for d in dist]]
+            elif refs:
+                results = [[rel(dist, ref[args.number])] for ref in refs]
+            else:
+                results = [[entropy(dist)]]
+        output(infile, results)
 
+    timinglog = TimingLog(args.timings) if args.timings else None
+    slowest = None
+    if args.profile is not None:
+        slowest = Slowest(args.profile, args.profilecount)
+    alltimings = []
+    for infile in args.input:
+        if timinglog is None and slowest is None:
+            process(infile)
+            continue
+        _, timings = measure(infile, lambda: process(infile), args.profile)
+        rows = timings.rows()
+        if slowest is not None:
+            slowest.add(infile, sum(r["seconds"] for r in rows if r["depth"] == 0))
+        if timinglog is not None:
+            timinglog.write(rows)
+            alltimings.extend(rows)
+    if timinglog is not None:
+        report(alltimings)
+        timinglog.close()
@@ -1,12 +1,11 @@
 import argparse, json
-from vtk import *
-from scipy.sparse import dok_matrix
+from collections import OrderedDict
 import numpy as np
-from math import sqrt, pi, cos
-from sys import argv, stdout
-from math import *
+from math import sqrt, pi, cos, sin
+from sys import stdout
 import logging
 import re
+from ta.timing import stage
 log = logging.getLogger("mesh")
 
 class TissueGridException(Exception):
@@ -22,252 +21,366 @@ class SparseMatrix(dict):
 def isDist(a):
     return abs(1.0 - sum(a)) < 0.1
 
+def timestep(filename):
+    """
+    Sort key that puts the numbered timesteps of a simulation in
+    numeric order
+    """
+    m = re.match(r"^(.*[^0-9])([0-9]+)\.[^.]*$", filename)
+    if m is None:
+        return (filename, -1)
+    prefix, time = m.groups()
+    return (prefix, int(time))
+
 def memoize(f):
     def m(self):
         n = "__" + f.__name__ + "_memo__"
         if not hasattr(self, n):
-            setattr(self, n, f(self))
+            with stage(f.__name__):
+                setattr(self, n, f(self))
         return getattr(self, n)
     return property(m)
 
+def prime(obj, **values):
+    """
+    Set the values of memoized properties without calculating them
+    """
+    for name, value in values.items():
+        setattr(obj, "__" + name + "_memo__", value)
+
+class TopologyCache(object):
+    """
+    Keeps structures derived only from mesh connectivity, such as the
+    adjacency, for the last few distinct topologies seen. Consecutive
+    timesteps of a simulation often have the same connectivity and
+    differ only in cell types or positions, so they can share them.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, topology, name, build):
+        if topology is None:
+            return build()
+        derived = self.entries.pop(topology, {})
+        self.entries[topology] = derived
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        if name not in derived:
+            derived[name] = build()
+        else:
+            log.debug("reusing %s for topology %s", name, topology)
+        return derived[name]
+
+topologies = TopologyCache()
+
+def csr_adjacency(shape, pairs):
+    """
+    Build a boolean CSR adjacency matrix from a sequence of (i, j)
+    pairs. Duplicate pairs are collapsed and column indices sorted.
+    """
+    from scipy.sparse import coo_matrix
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    data = np.ones(len(pairs), dtype=bool)
+    adj = coo_matrix((data, (pairs[:,0], pairs[:,1])), shape=shape).tocsr()
+    adj.sum_duplicates()
+    adj.sort_indices()
+    return adj
+
+def incidence_adjacency(offsets, connectivity, npoints, edges=False):
+    """
+    Derive cell-cell adjacency from cell connectivity in one sparse
+    product. The points of cell i are connectivity[offsets[i]:offsets[i+1]].
+    Cells are adjacent if they share a point, or if edges is true, if
+    they share a polygon edge.
+    """
+    from scipy.sparse import csr_matrix
+    offsets = np.asarray(offsets, dtype=np.int64)
+    connectivity = np.asarray(connectivity, dtype=np.int64)
+    ncells = len(offsets) - 1
+    counts = np.diff(offsets)
+    rows = np.repeat(np.arange(ncells), counts)
+    if edges:
+        # each vertex is joined to its successor, wrapping around at
+        # the end of its polygon
+        succ = np.arange(len(connectivity)) + 1
+        nonempty = counts > 0
+        succ[offsets[1:][nonempty] - 1] = offsets[:-1][nonempty]
+        a, b = connectivity, connectivity[succ]
+        keys = np.minimum(a, b) * npoints + np.maximum(a, b)
+        edgeids, cols = np.unique(keys, return_inverse=True)
+        ncols = len(edgeids)
+    else:
+        cols = connectivity
+        ncols = npoints
+    data = np.ones(len(rows), dtype=np.int32)
+    incidence = csr_matrix((data, (rows, cols)), shape=(ncells, ncols))
+    shared = (incidence * incidence.T).tocoo()
+    offdiag = shared.row != shared.col
+    return csr_adjacency((ncells, ncells),
+                         np.column_stack((shared.row[offdiag], shared.col[offdiag])))
+
 class Mesh(object):
+    ## fingerprint of the connectivity, if it is known
+    topology = None
+
     def __len__(self):
         return len(self.types)
-    def neighbours(self, i):
-        return [j for (_, j) in self.adjacencies[i, :].keys()]
-
-
-class VtuMesh(Mesh):
-    def __init__(self, file_name):
-        self.filename = file_name
-        reader = vtkXMLUnstructuredGridReader()
-        reader.SetFileName(file_name)
-        reader.Update()
-        self.ug = reader.GetOutput()
-
-    def __str__(self):
-        return "VtuMesh(%s)" % repr(self.filename)
 
     @memoize
-    def shape(self):
-        return (len(self), len(self))
-    def __len__(self):
-        return self.ug.GetNumberOfCells()
+    def neighbourIndex(self):
+        """
+        The adjacency as a CSR (indptr, indices) pair of arrays, so
+        that the neighbours of cell i are indices[indptr[i]:indptr[i+1]]
+        """
+        adj = self.adjacencies.tocsr()
+        adj.sort_indices()
+        return adj.indptr, adj.indices
 
-    @property
-    def timestamp(self):
-        m = re.match(r"^.*[^0-9]([0-9]*)\.vtu$", self.filename)
-        time, = m.groups()
-        return time
+    def neighbours(self, i):
+        indptr, indices = self.neighbourIndex
+        return indices[indptr[i]:indptr[i+1]]
 
     @memoize
-    def types(self):
-        celldata = self.ug.GetCellData()
-        for i in range(celldata.GetNumberOfArrays()):
-            data = celldata.GetArray(i)
-            if data.GetName() == "cell type":
-                tuples = [data.GetTuple(c) for c in
-                          range(data.GetNumberOfTuples())]
-                return np.array(list(t for t, in tuples))
-        for i in range(celldata.GetNumberOfArrays()):
-            data = celldata.GetArray(i)
-            if data.GetName() == "Cell types":
-                tuples = [data.GetTuple(c) for c in
-                          range(data.GetNumberOfTuples())]
-                return np.array(list(t for t, in tuples))
-
-        raise TissueGridException("No data about cell types")
+    def geometry(self):
+        """
+        Polygons as an (offsets, coords) pair, a flat (n, 2) coordinate
+        buffer where the vertices of cell i are coords[offsets[i]:offsets[i+1]]
+        """
+        counts = [len(gon) for gon in self.polygons]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        coords = np.array([xy for gon in self.polygons for xy in gon],
+                          dtype=float).reshape(-1, 2)
+        return offsets, coords
 
     @memoize
-    def adjacencies(self):
-        def getNeighbours(c):
-            neighbours = []
-            points = vtkIdList()
-            self.ug.GetCellPoints(c, points)
-            for i in range(points.GetNumberOfIds()):
-                plist = vtkIdList()
-                plist.InsertNextId(points.GetId(i))
-                nlist = vtkIdList()
-
-                self.ug.GetCellNeighbors(c, plist, nlist)
-                for j in range(nlist.GetNumberOfIds()):
-                    neighbours.append(nlist.GetId(j))
-            return set(neighbours)
-
-        adj = dok_matrix(self.shape, dtype=bool)
-        for i in range(len(self)):
-            for j in getNeighbours(i):
-                adj[i,j] = True
-        return adj
+    def typeIndex(self):
+        """
+        The distinct cell types in order, and for each cell the index
+        of its type among them
+        """
+        return np.unique(np.asarray(self.types), return_inverse=True)
 
     @memoize
-    def polygons(self):
-        def _poly():
-            for i in range(len(self)):
-                points = vtkIdList()
-                self.ug.GetCellPoints(i, points)
-                gon = []
-                for p in range(points.GetNumberOfIds()):
-                    (x, y, _) = self.ug.GetPoint(points.GetId(p))
-                    gon.append((x, y))
-                yield gon
-        return list(_poly())
+    def contacts(self):
+        """
+        Dense type-by-type matrix, entry i, j counts the adjacencies
+        from a cell of the i-th type to a cell of the j-th type
+        """
+        from scipy.sparse import csr_matrix
+        values, codes = self.typeIndex
+        n, k = len(codes), len(values)
+        onehot = csr_matrix((np.ones(n, dtype=np.int64), (np.arange(n), codes)),
+                            shape=(n, k))
+        adj = self.adjacencies.astype(np.int64)
+        return (onehot.T * adj * onehot).toarray()
 
     @memoize
     def demographics(self):
-        typemap = {}
-        for t in self.types:
-            typemap[t] = typemap.get(t, 0) + 1
-        total = sum(typemap.values())
-        ks = typemap.keys()
-        ks.sort()
-        demo = []
-        for k in ks:
-            demo.append(float(typemap[k])/total)
+        _, codes = self.typeIndex
+        demo = np.bincount(codes) / float(len(codes))
         assert isDist(demo)
-        return np.array(demo)
+        return demo
 
     @memoize
     def neighbourStats(self):
-        pr = {}
-        for i in range(len(self)):
-            itype = self.types[i]
-            typestats = pr.setdefault(itype, {})
-            for j in self.neighbours(i):
-                ntype = self.types[j]
-                typestats[ntype] = typestats.get(ntype, 0) + 1
-        npr = []
-        ks = pr.keys()
-        ks.sort()
-        for i in ks:
-            p = []
-            total = sum(pr[i].values())
-            js = pr[i].keys()
-            js.sort()
-            for j in js: 
-                p.append(float(pr[i][j])/total)
-            assert isDist(p)
-            npr.append(p)
-        return np.array(npr)
+        contacts = self.contacts.astype(float)
+        totals = contacts.sum(axis=1)[:, None]
+        return np.divide(contacts, totals, out=np.zeros_like(contacts),
+                         where=totals > 0)
 
     @memoize
     def entropy(self):
-        from math import log 
-        demo = self.demographics
-        nstats = self.neighbourStats
-        dist = []
-        for i in range(len(demo)):
-            for j in range(len(demo)):
-                dist.append(demo[i] * nstats[i,j])
-        return -1 * sum(p * log(p, 2) for p in dist)
+        dist = self.demographics[:, None] * self.neighbourStats
+        p = dist[dist > 0]
+        return float((p * np.log2(1 / p)).sum())
+
 
 class DictMesh(Mesh):
     def __init__(self, data):
+        data = dict(data)
+        if "polygons" in data:
+            prime(self, polygons=data.pop("polygons"))
         self.__dict__.update(data)
         if isinstance(self.shape, list):
             self.shape = tuple(self.shape)
         if isinstance(self.adjacencies, list):
-            keys = self.adjacencies
-            self.adjacencies = dok_matrix(self.shape, dtype=bool)
-            for (i,j) in keys: self.adjacencies[i,j] = True
+            self.adjacencies = csr_adjacency(self.shape, self.adjacencies)
+        else:
+            self.adjacencies = self.adjacencies.tocsr()
 
-def mklattice(n, m):
+    @memoize
+    def polygons(self):
+        ## only called when the mesh was made without polygons, they
+        ## come from the geometry if that was primed instead. Slicing a
+        ## plain view is much faster than slicing a memmap.
+        if not hasattr(self, "__geometry_memo__"):
+            raise TissueGridException("mesh has no polygons")
+        offsets, coords = self.geometry
+        return np.split(np.asarray(coords), offsets[1:-1])
+
+## binary interchange format: this line followed by the types, edge
+## list, polygon offsets and polygon coordinates as .npy records
+MAGIC = b"TAMESH1\n"
+
+def dumpmesh(mesh, fp):
+    """
+    Write a mesh to a stream in the binary interchange format. Each
+    array is written as it is, without building intermediate lists.
+    """
+    adj = mesh.adjacencies.tocoo()
+    offsets, coords = mesh.geometry
+    fp.write(MAGIC)
+    for a in (np.asarray(mesh.types), np.column_stack((adj.row, adj.col)),
+              offsets, coords):
+        np.lib.format.write_array(fp, np.ascontiguousarray(a))
+
+def meshdata(mesh):
+    """
+    The mesh as a dictionary of lists in the JSON interchange format
+    """
+    adj = mesh.adjacencies.tocoo()
+    offsets, coords = mesh.geometry
+    return {
+        "types": np.asarray(mesh.types).tolist(),
+        "polygons": [coords[offsets[i]:offsets[i+1]].tolist()
+                     for i in range(len(offsets) - 1)],
+        "shape": (len(mesh), len(mesh)),
+        "adjacencies": np.column_stack((adj.row, adj.col)).tolist()
+    }
+
+def loadmesh(fp):
+    """
+    Read a mesh in the binary interchange format from a stream, which
+    need not be seekable
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise TissueGridException("not a binary mesh")
+    types, edges, offsets, coords = [np.lib.format.read_array(fp)
+                                     for _ in range(4)]
+    n = len(types)
+    mesh = DictMesh({
+        "types": types,
+        "shape": (n, n),
+        "adjacencies": csr_adjacency((n, n), edges),
+    })
+    prime(mesh, geometry=(offsets, coords))
+    return mesh
+
+def readmesh(filename):
+    """
+    Read a DictMesh from a file in either the binary or the JSON format
+    """
+    with open(filename, "rb") as fp:
+        if fp.read(len(MAGIC)) == MAGIC:
+            fp.seek(0)
+            return loadmesh(fp)
+        fp.seek(0)
+        return DictMesh(json.loads(fp.read()))
+
+def mkpattern(n, m, pattern, seed=None):
+    """
+    Cell types for an n by m lattice. The patterns are stripes,
+    tstripes, checker and random, anything else is a single type.
+    """
+    cells = np.arange(n*m)
+    if pattern == "stripes":
+        return (cells // m) % 3
+    if pattern == "tstripes":
+        return (cells // m // 3) % 3
+    if pattern == "checker":
+        return (cells // n) % 3
+    if pattern == "random":
+        return np.random.RandomState(seed).randint(3, size=n*m)
+    return np.zeros(n*m, dtype=int)
+
+def mklattice(n, m, pattern=None, seed=None):
     R = sqrt(2.0 / (3*sqrt(3)))
     r = R*cos(pi/6)
-    def hexagon(x, y):
-        for angle in [0, pi/3, 2*pi/3, pi, 4*pi/3, 5*pi/3]:
-            yield (x + R + cos(angle)*R, y + sin(angle)*R)
-
-    def ident(i, j):
-        return j*n + i
-
-    lattice = {
-        "types": [],
-        "polygons": [],
-        "shape": (n*m,n*m),
-        "adjacencies": dok_matrix((n*m,n*m), dtype=bool)
-    }
-    def inbox(i):
-        return i >= 0 and i < n*m
-    def leftof(i, j):
-        return i % n >= j % n
-    def rightof(i, j):
-        return i % n <= j % n
-    for j in range(m):
-        for i in range(n):
-            lattice["types"].append(0)
-            xshift = 0 if j % 2 == 0 else 1.5*R
-            xoffset = i*(2*R + R) + xshift
-            yoffset = j*r + r
-            lattice["polygons"].append(list(hexagon(xoffset, yoffset)))
-
-            cid = ident(i,j)
-
-            nn  = cid - 2*n
-            ss  = cid + 2*n
-
-            evenrow = j % 2 == 0
-            evencol = i % 2 == 0
-            if evenrow:
-                se = cid + n
-                nw = cid - n - 1
-            else:
-                se = cid + n + 1
-                nw = cid - n
-            sw = se - 1
-            ne = nw + 1
-
-            if inbox(nn): lattice["adjacencies"][cid, nn] = True
-            if inbox(ne) and rightof(cid, ne): lattice["adjacencies"][cid, ne] = True
-            if inbox(se) and rightof(cid, se): lattice["adjacencies"][cid, se] = True
-            if inbox(ss): lattice["adjacencies"][cid, ss] = True
-            if inbox(sw) and leftof(cid, sw): lattice["adjacencies"][cid, sw] = True
-            if inbox(nw) and leftof(cid, nw): lattice["adjacencies"][cid, nw] = True
-
-    return DictMesh(lattice)
+    angles = [0, pi/3, 2*pi/3, pi, 4*pi/3, 5*pi/3]
+    cosines = np.array([cos(angle) for angle in angles])
+    sines = np.array([sin(angle) for angle in angles])
+
+    cid = np.arange(n*m)
+    i, j = cid % n, cid // n
+    evenrow = j % 2 == 0
+
+    xshift = np.where(evenrow, 0, 1.5*R)
+    xoffset = i*(2*R + R) + xshift
+    yoffset = j*r + r
+    coords = np.empty((n*m, 6, 2))
+    coords[:,:,0] = (xoffset + R)[:, None] + cosines*R
+    coords[:,:,1] = yoffset[:, None] + sines*R
+    coords = coords.reshape(-1, 2)
+    offsets = np.arange(0, 6*n*m + 1, 6)
+
+    nn = cid - 2*n
+    ss = cid + 2*n
+    se = np.where(evenrow, cid + n, cid + n + 1)
+    nw = np.where(evenrow, cid - n - 1, cid - n)
+    sw = se - 1
+    ne = nw + 1
+
+    def inbox(x):
+        return (x >= 0) & (x < n*m)
+    def leftof(x):
+        return i >= x % n
+    def rightof(x):
+        return i <= x % n
+    neighbours = [
+        (nn, inbox(nn)),
+        (ne, inbox(ne) & rightof(ne)),
+        (se, inbox(se) & rightof(se)),
+        (ss, inbox(ss)),
+        (sw, inbox(sw) & leftof(sw)),
+        (nw, inbox(nw) & leftof(nw)),
+    ]
+    rows = np.concatenate([cid[keep] for _, keep in neighbours])
+    cols = np.concatenate([x[keep] for x, keep in neighbours])
+
+    lattice = DictMesh({
+        "types": mkpattern(n, m, pattern, seed),
+        "shape": (n*m, n*m),
+        "adjacencies": csr_adjacency((n*m, n*m), np.column_stack((rows, cols)))
+    })
+    prime(lattice, geometry=(offsets, coords))
+    return lattice
 
 def lattice():
     parser = argparse.ArgumentParser(prog='plattice')
     parser.add_argument('-n', dest='n', default="4", type=int, help='lattice size')
     parser.add_argument('-m', dest='m', default="16", type=int, help='lattice size')
     parser.add_argument('-p', dest='pattern', default="checker", help='lattice pattern')
+    parser.add_argument('-s', dest='seed', default=None, type=int,
+                        help='random seed for the random pattern')
+    parser.add_argument('-b', dest='binary', action='store_true', default=False,
+                        help='write the binary format instead of JSON')
 
     args = parser.parse_args()
 
-    lat = mklattice(args.n, args.m)
-    data = lat.__dict__
-    data["adjacencies"] = data["adjacencies"].keys()
-
-    if args.pattern == "stripes":
-        for i in range(len(lat.types)):
-            for k in range(3):
-                if (i/args.m) % 3 == k:
-                    lat.types[i] = k
-    elif args.pattern == "tstripes":
-        for i in range(len(lat.types)):
-            for k in range(3):
-                if (i/args.m/3) % 3 == k:
-                    lat.types[i] = k
-    elif args.pattern == "checker":
-        for i in range(len(lat.types)):
-            for k in range(3):
-                if (i/args.n) % 3 == k:
-                    lat.types[i] = k
-    elif args.pattern == "random":
-        from random import seed, choice
-        from time import time
-        seed(time())
-        for i in range(len(lat.types)):
-            lat.types[i] = choice([0,1,2])
-
-    print json.dumps(data)
+    lat = mklattice(args.n, args.m, args.pattern, args.seed)
+    if args.binary:
+        dumpmesh(lat, stdout)
+        return
 
-def meshstats(db, m):
+    print json.dumps(meshdata(lat))
+
+def meshsummary(m):
+    """
+    Calculate the per-mesh statistics as a (time, size, entropy) tuple
+    """
     log.info("calculating mesh stats %s", m)
-    mid = db.meshfile(m.filename)
+    return (m.timestamp, len(m), m.entropy)
+
+def savemeshstats(db, filename, summary):
+    mid = db.meshfile(filename)
     cur = db.conn.cursor()
     cur.execute("""
     UPDATE meshfiles
     SET time=?, size=?, entropy=?
     WHERE id=?
-    """, (m.timestamp, len(m), m.entropy, mid))
+    """, tuple(summary) + (mid,))
+
+def meshstats(db, m):
+    savemeshstats(db, m.filename, meshsummary(m))
@@ -1,45 +1,180 @@
 import argparse
 from glob import glob
-from os import path, system
+from os import path, system, listdir, makedirs
 from sys import exit
-from mesh import VtuMesh, DictMesh
-from PIL import Image, ImageDraw
+from functools import partial
+from multiprocessing import Pool
+from shutil import rmtree
+from tempfile import mkdtemp
+import numpy as np
+from cache import load
+from mesh import Mesh, prime, timestep
+from summary import SummaryStore, exportseries
 from ta.colours import colours
-import json
 import re
 
-def main():
-    parser = argparse.ArgumentParser(prog='eplot')
-    parser.add_argument('-o', dest='output', help='output directory')
-    parser.add_argument('data', help='data spec (file prefix, up to -pop)')
-
-    args = parser.parse_args()
-
-    pop_re = re.compile(r'%s-pop([0-9]+\.[0-9]+).*.entropy.dat' % args.data)
+def plotscript(data, output):
+    """
+    Write a gnuplot script that plots the entropy series of each
+    population of the data spec, returning the script's file name
+    """
+    pop_re = re.compile(r'%s-pop([0-9]+\.[0-9]+).*.entropy.dat' % data)
     def pop(f):
         m = pop_re.match(f)
         if m is not None:
             return f, m.groups()[0]
-    pops = list(pop(f) for f in glob("%s-pop*.entropy.dat" % (args.data)))
+    pops = list(pop(f) for f in glob("%s-pop*.entropy.dat" % (data)))
     pops.sort(lambda x, y: cmp(x[1], y[1]))
 
-    base = path.basename(args.data)
+    base = path.basename(data)
 
     def plotline(pop):
         dat, pop = pop
         return '\t"%s" using 1:2 with lines title "%s"' % (dat, pop)
 
-    plot = path.join(args.output, "%s.plt" % base)
+    plot = path.join(output, "%s.plt" % base)
     with open(plot, "w") as fp:
         fp.write("""
 set terminal png
 set output "%s.png"
 
 plot \\
-""" % path.join(args.output, base))
+""" % path.join(output, base))
         fp.write(", \\\n".join(plotline(pop) for pop in pops))
         fp.write("\n")
-    system("gnuplot %s" % plot)
+    return plot
+
+def main():
+    parser = argparse.ArgumentParser(prog='eplot')
+    parser.add_argument('-o', dest='output', help='output directory')
+    parser.add_argument('-s', dest='store', default=None,
+                        help='summary store to export the entropy series from, '
+                        'into the output directory')
+    parser.add_argument('data', nargs='+', help='data spec (file prefix, up to -pop)')
+
+    args = parser.parse_args()
+
+    specs = args.data
+    if args.store is not None:
+        names = ["%s-pop*" % path.basename(data) for data in specs]
+        exportseries(SummaryStore(args.store), "entropy", args.output, names)
+        specs = [path.join(args.output, path.basename(data)) for data in specs]
+
+    plots = [plotscript(data, args.output) for data in specs]
+    system("gnuplot %s" % " ".join(plots))
+
+def extent(mesh):
+    """
+    The bounding box corners and the range of cell types of a mesh
+    """
+    _, coords = mesh.geometry
+    types = np.asarray(mesh.types)
+    return coords.min(axis=0), coords.max(axis=0), types.min(), types.max()
+
+def colourmap(ncolours, mint, maxt):
+    def cmap(f):
+        c = int(ncolours * (f - mint)/(maxt - mint))
+        return colours[c]
+
+    def gmap(f):
+        g = int(255 * (f - mint)/(maxt - mint))
+        return (g, g, g)
+
+    def onekind(f):
+        return (255, 255, 255)
+
+    if mint == maxt:
+        return onekind
+    if ncolours is None:
+        return gmap
+    return cmap
+
+def mute(c):
+    return tuple( ((x + 128) % 255) for x in c )
+
+def render(mesh, size, bounds, trange, ncolours=None, outline=False, index=False):
+    """
+    Draw the mesh on a new image of the given (width, height). bounds
+    is the (lo, hi) corners of the region shown and trange the (min,
+    max) cell type, so that the frames of a series can share them.
+    """
+    width, height = size
+    lo, hi = bounds
+    from PIL import Image, ImageDraw
+    image = Image.new("RGB", (width, height), (255, 255, 255))
+    canvas = ImageDraw.Draw(image)
+
+    offsets, coords = mesh.geometry
+    scale = np.array(size, dtype=float)
+    xy = (scale * (coords - lo) / (hi - lo)).astype(int).ravel().tolist()
+
+    cmap = colourmap(ncolours, *trange)
+    types = np.asarray(mesh.types).tolist()
+    fills = dict((t, cmap(t)) for t in set(types))
+    kv = {}
+    for i in range(len(offsets) - 1):
+        fill = fills[types[i]]
+        if outline:
+            kv["outline"] = mute(fill)
+        canvas.polygon(xy[2*offsets[i]:2*offsets[i+1]], fill=fill, **kv)
+
+    if index:
+        counts = np.diff(offsets)
+        centroids = np.add.reduceat(coords, offsets[:-1]) / counts[:, None]
+        cxy = (scale * (centroids - lo) / (hi - lo)).astype(int).tolist()
+        for i, c in enumerate(cxy):
+            canvas.text(tuple(c), str(i), (0,0,0))
+    return image
+
+def _extent(job, format):
+    """
+    Load a mesh and keep what rendering it needs in a scratch file, so
+    that it is only read and decoded once
+    """
+    filename, scratch = job
+    m = load(filename, format)
+    offsets, coords = m.geometry
+    with open(scratch, "wb") as fp:
+        np.savez(fp, types=np.asarray(m.types), offsets=offsets, coords=coords)
+    return extent(m)
+
+def _frame(job, size, bounds, trange, options):
+    scratch, output = job
+    data = np.load(scratch)
+    m = Mesh()
+    m.types = data["types"]
+    prime(m, geometry=(data["offsets"], data["coords"]))
+    image = render(m, size, bounds, trange, **options)
+    image.save(output, "PNG")
+    return output
+
+def frames(inputs, outdir, format, size, options, jobs=1):
+    """
+    Render each of the input meshes to a PNG frame in outdir, in a
+    pool of jobs processes, with a bounding box and colour scale
+    shared across all of them. Returns the frame filenames in order.
+    """
+    pool = Pool(jobs) if jobs > 1 else None
+    pmap = pool.map if pool is not None else map
+    scratch = mkdtemp(prefix="pmesh")
+    scratches = [path.join(scratch, "%d.npz" % i) for i in range(len(inputs))]
+
+    try:
+        extents = pmap(partial(_extent, format=format), zip(inputs, scratches))
+        bounds = (np.min([e[0] for e in extents], axis=0),
+                  np.max([e[1] for e in extents], axis=0))
+        trange = (min(e[2] for e in extents), max(e[3] for e in extents))
+
+        outputs = [path.join(outdir, path.splitext(path.basename(f))[0] + ".png")
+                   for f in inputs]
+        pmap(partial(_frame, size=size, bounds=bounds, trange=trange,
+                     options=options), zip(scratches, outputs))
+    finally:
+        rmtree(scratch, ignore_errors=True)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return outputs
 
 def mesh():
     parser = argparse.ArgumentParser(prog='pmesh')
@@ -52,6 +187,14 @@ def mesh():
                         help='show cell indices')
     parser.add_argument('-c', dest='colours', type=int, default=None,
                         help='generate a colour plot')
+    parser.add_argument('-b', dest='batch', action='store_true', default=False,
+                        help='render a directory or glob of meshes to a directory of frames')
+    parser.add_argument('-j', dest='jobs', type=int, default=1,
+                        help='number of worker processes in batch mode')
+    parser.add_argument('-a', dest='animation', default=None,
+                        help='stitch batch frames into this animated GIF')
+    parser.add_argument('--fps', dest='fps', type=float, default=10,
+                        help='animation frame rate')
     parser.add_argument('input', help='input file')
     parser.add_argument('output', help='output file')
 
@@ -61,76 +204,39 @@ def mesh():
         print("invalid geometry: %s" % args.geometry)
         exit(255)
 
+    width, height = map(int, gre.groups())
+    options = {
+        "ncolours": args.colours,
+        "outline": args.outline,
+        "index": args.index,
+    }
+
+    if args.batch:
+        if path.isdir(args.input):
+            inputs = [path.join(args.input, f) for f in listdir(args.input)
+                      if args.format.lower() != 'vtu' or f.endswith('.vtu')]
+        else:
+            inputs = glob(args.input)
+        inputs.sort(key=timestep)
+        if not path.isdir(args.output):
+            makedirs(args.output)
+        outputs = frames(inputs, args.output, args.format, (width, height),
+                         options, args.jobs)
+        if args.animation is not None and outputs:
+            from PIL import Image
+            images = [Image.open(f) for f in outputs]
+            images[0].save(args.animation, save_all=True,
+                           append_images=images[1:], loop=0,
+                           duration=int(1000 / args.fps))
+        return
+
     try:
         _, ext = args.output.rsplit(".", 1)
     except ValueError:
         print("invalid image filename: %s" % args.output)
         exit(255)
 
-    width, height = map(int, gre.groups())
-    image = Image.new("RGB", (width, height), (255, 255, 255))
-
-
-    if args.format.lower() == 'vtu':
-        mesh = VtuMesh(args.input)
-    else:
-        with open(args.input) as fp:
-            data = json.loads(fp.read())
-        mesh = DictMesh(data)
-
-    xmin, xmax, ymin, ymax = 2**32, 0, 2**32, 0
-    for gon in mesh.polygons:
-        for x, y in gon:
-            if x < xmin: xmin = x
-            if x > xmax: xmax = x
-            if y < ymin: ymin = y
-            if y > ymax: ymax = y
-
-    def scale((x, y)):
-        return (
-            int(width * (x - xmin) / (xmax - xmin)),
-            int(height * (y - ymin) / (ymax - ymin))
-            )
-
-    mint, maxt = 2**32, 0
-    for f in mesh.types:
-        if f < mint: mint = f
-        if f > maxt: maxt = f
-
-    def cmap(f):
-        c = int(args.colours * (f - mint)/(maxt - mint))
-        return colours[c]
-
-    def gmap(f):
-        g = int(255 * (f - mint)/(maxt - mint))
-        return (g, g, g)
-
-    def onekind(f):
-        return (255, 255, 255)
-
-    def mute(c):
-        return tuple( ((c + 128) % 255) for c in cmap(f) )
-
-    if mint == maxt:
-        cmap = onekind
-    if args.colours is None:
-        cmap = gmap
-
-    canvas = ImageDraw.Draw(image)
-    kv = {}
-
-    def centroid(gon):
-        xs = [x[0] for x in gon]
-        ys = [y[1] for y in gon]
-        return (sum(xs)/len(gon), sum(ys)/len(gon))
-
-    for i in range(len(mesh)):
-        gon = mesh.polygons[i]
-        flavour = mesh.types[i]
-        if args.outline:
-            kv["outline"] = mute(cmap(flavour))
-        canvas.polygon(map(scale, gon), fill=cmap(flavour), **kv)
-        if args.index:
-            canvas.text(scale(centroid(gon)), str(i), (0,0,0))
-
+    mesh = load(args.input, args.format)
+    lo, hi, mint, maxt = extent(mesh)
+    image = render(mesh, (width, height), (lo, hi), (mint, maxt), **options)
     image.save(args.output, ext.upper())
@@ -0,0 +1,290 @@
+import argparse
+import logging
+import os
+import re
+import sys
+from itertools import groupby
+from os import path
+
+from ta.db import Database
+
+log = logging.getLogger("summary")
+
+tables = {
+    "datasets": """
+        CREATE TABLE datasets (
+            id INTEGER PRIMARY KEY,
+            name VARCHAR,
+            population DOUBLE,
+            source VARCHAR,
+            filesize INTEGER,
+            mtime DOUBLE
+        )
+    """,
+    "meshes": """
+        CREATE TABLE meshes (
+            id INTEGER PRIMARY KEY,
+            dataset INTEGER REFERENCES datasets(id),
+            source INTEGER,
+            run VARCHAR,
+            name VARCHAR,
+            time INTEGER,
+            size INTEGER,
+            entropy DOUBLE
+        )
+    """,
+    "clusters": """
+        CREATE TABLE clusters (
+            mesh INTEGER REFERENCES meshes(id),
+            type DOUBLE,
+            size INTEGER
+        )
+    """,
+}
+
+indexes = {
+    "datasets_source": "CREATE INDEX IF NOT EXISTS datasets_source ON datasets(source)",
+    "datasets_name": "CREATE INDEX IF NOT EXISTS datasets_name ON datasets(name)",
+    "meshes_time": "CREATE INDEX IF NOT EXISTS meshes_time ON meshes(dataset, time)",
+    "meshes_source": "CREATE INDEX IF NOT EXISTS meshes_source ON meshes(dataset, source)",
+    "clusters_mesh": "CREATE INDEX IF NOT EXISTS clusters_mesh ON clusters(mesh)",
+}
+
+## the population is part of the dataset name, as in name-pop0.5
+population_re = re.compile(r"-pop([0-9]+(?:\.[0-9]+)?)")
+
+def metadata(dbfile, pattern=None):
+    """
+    The dataset name and population of a summary database, parsed
+    from its path. The dataset is the directory the database is in,
+    and the population comes from a -popN part of the name, unless
+    pattern is a regular expression whose named groups dataset and
+    population match them in the path.
+    """
+    groups = {}
+    if pattern is not None:
+        m = re.search(pattern, path.abspath(dbfile))
+        if m is not None:
+            groups = m.groupdict()
+    name = groups.get("dataset") or path.basename(path.dirname(path.abspath(dbfile)))
+    population = groups.get("population")
+    if population is None:
+        m = population_re.search(name)
+        if m is not None:
+            population = m.group(1)
+    return name, None if population is None else float(population)
+
+def summaryfiles(inputs, filename="summary.db"):
+    """
+    The summary databases among inputs, searching directories for
+    files with the given name
+    """
+    for i in inputs:
+        if not path.isdir(i):
+            yield i
+            continue
+        for d, _, fs in os.walk(i):
+            if filename in fs:
+                yield path.join(d, filename)
+
+class SummaryStore(Database):
+    """
+    The statistics of many datasets consolidated into one database,
+    each dataset having been calculated into its own summary database
+    by tstats
+    """
+    tables = tables
+    columns = {}
+    indexes = indexes
+
+    def __init__(self, dbfile, bulk=False):
+        Database.__init__(self, dbfile, bulk)
+        self.conn.create_function("dirname", 1, path.dirname)
+
+    def _delete(self, dataset):
+        cur = self.conn.cursor()
+        cur.execute("""
+        DELETE FROM clusters WHERE mesh IN (SELECT id FROM meshes WHERE dataset=?)
+        """, (dataset,))
+        cur.execute("DELETE FROM meshes WHERE dataset=?", (dataset,))
+
+    def merge(self, dbfile, pattern=None, force=False):
+        """
+        Copy the statistics in a summary database into the store,
+        replacing any copied from it before. Returns False without
+        copying anything if the database has not changed since.
+        """
+        source = path.abspath(dbfile)
+        st = os.stat(dbfile)
+        name, population = metadata(dbfile, pattern)
+        cur = self.conn.cursor()
+        cur.execute("SELECT id, filesize, mtime FROM datasets WHERE source=?", (source,))
+        row = cur.fetchone()
+        if row is not None and not force and tuple(row[1:]) == (st.st_size, st.st_mtime):
+            return False
+
+        cur.execute("ATTACH DATABASE ? AS src", (dbfile,))
+        try:
+            if row is None:
+                cur.execute("""
+                INSERT INTO datasets(name, population, source, filesize, mtime)
+                VALUES(?, ?, ?, ?, ?)
+                """, (name, population, source, st.st_size, st.st_mtime))
+                dataset = cur.lastrowid
+            else:
+                dataset = row[0]
+                self._delete(dataset)
+                cur.execute("""
+                UPDATE datasets SET name=?, population=?, filesize=?, mtime=?
+                WHERE id=?
+                """, (name, population, st.st_size, st.st_mtime, dataset))
+            cur.execute("""
+            INSERT INTO meshes(dataset, source, run, name, time, size, entropy)
+            SELECT ?, id, dirname(file), name, CAST(time AS INTEGER), size, entropy
+            FROM src.meshfiles
+            """, (dataset,))
+            cur.execute("""
+            INSERT INTO clusters(mesh, type, size)
+            SELECT m.id, c.type, c.size
+            FROM src.clusters c JOIN meshes m ON m.dataset=? AND m.source=c.mesh
+            """, (dataset,))
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.execute("DETACH DATABASE src")
+        return True
+
+def selection(names=None, pmin=None, pmax=None):
+    """
+    SQL condition on datasets d, and its parameters, for datasets
+    whose names match any of the glob patterns in names and whose
+    population is between pmin and pmax
+    """
+    clauses = []
+    params = []
+    if names:
+        clauses.append("(%s)" % " OR ".join("d.name GLOB ?" for _ in names))
+        params.extend(names)
+    if pmin is not None:
+        clauses.append("d.population >= ?")
+        params.append(pmin)
+    if pmax is not None:
+        clauses.append("d.population <= ?")
+        params.append(pmax)
+    return " AND ".join(clauses) or "1", params
+
+## queries for each kind of series, rows start with the dataset name
+## and population and are in order of dataset and time
+queries = {
+    "entropy": """
+        SELECT d.name, d.population, m.time, m.entropy
+        FROM meshes m JOIN datasets d ON d.id=m.dataset
+        WHERE m.entropy IS NOT NULL AND %s
+        ORDER BY d.name, m.time, m.run
+    """,
+    "clusters": """
+        SELECT d.name, d.population, m.time, c.type,
+               COUNT(*), AVG(c.size), MAX(c.size)
+        FROM clusters c
+        JOIN meshes m ON m.id=c.mesh
+        JOIN datasets d ON d.id=m.dataset
+        WHERE %s
+        GROUP BY m.id, c.type
+        ORDER BY d.name, m.time, m.run, c.type
+    """,
+}
+
+def series(store, kind, names=None, pmin=None, pmax=None):
+    """
+    The time series of one kind for the selected datasets, from a
+    single query. For entropy the rows are (dataset, population,
+    time, entropy); for clusters they are (dataset, population, time,
+    type, number, mean size, largest size).
+    """
+    where, params = selection(names, pmin, pmax)
+    cur = store.conn.cursor()
+    cur.execute(queries[kind] % where, params)
+    return cur
+
+def _format(v):
+    if v is None:
+        return "nan"
+    if isinstance(v, float):
+        ## as the sqlite3 shell prints them
+        s = "%.15g" % v
+        if s.lstrip("-").isdigit():
+            s += ".0"
+        return s
+    return str(v)
+
+def _line(values):
+    return " ".join(_format(v) for v in values)
+
+def exportseries(store, kind, output, names=None, pmin=None, pmax=None):
+    """
+    Write the series of each selected dataset to output/name.kind.dat,
+    a line for each row without the dataset and population, and
+    return the names of the files written
+    """
+    written = []
+    rows = series(store, kind, names, pmin, pmax)
+    for name, group in groupby(rows, key=lambda row: row[0]):
+        filename = path.join(output, "%s.%s.dat" % (name, kind))
+        with open(filename, "w") as fp:
+            for row in group:
+                fp.write(_line(row[2:]) + "\n")
+        written.append(filename)
+    return written
+
+def merge():
+    parser = argparse.ArgumentParser(prog='tmerge')
+    parser.add_argument('-d', dest='db', help='summary store to merge into')
+    parser.add_argument('-n', dest='name', default='summary.db',
+                        help='name of the summary databases to look for in directories')
+    parser.add_argument('-p', dest='pattern', default=None,
+                        help='regular expression with dataset and population groups '
+                        'to match in database paths')
+    parser.add_argument('--bulk', dest='bulk', action='store_true',
+                        help='use write-ahead logging for faster loading')
+    parser.add_argument('--force', dest='force', action='store_true',
+                        help='copy databases that have not changed')
+    parser.add_argument('input', nargs='+',
+                        help='summary databases or directories containing them')
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)s %(message)s',
+        level=logging.INFO
+    )
+    args = parser.parse_args()
+
+    store = SummaryStore(args.db, bulk=args.bulk)
+    for dbfile in summaryfiles(args.input, args.name):
+        if store.merge(dbfile, args.pattern, args.force):
+            log.info("merged %s", dbfile)
+        else:
+            log.debug("skipping unchanged %s", dbfile)
+
+def export():
+    parser = argparse.ArgumentParser(prog='texport')
+    parser.add_argument('-d', dest='db', help='summary store')
+    parser.add_argument('-k', dest='kind', default='entropy', choices=sorted(queries),
+                        help='series to export')
+    parser.add_argument('-o', dest='output', default='-',
+                        help='directory for a .dat file per dataset, or - for a '
+                        'single table on standard output')
+    parser.add_argument('--pmin', dest='pmin', default=None, type=float,
+                        help='smallest population')
+    parser.add_argument('--pmax', dest='pmax', default=None, type=float,
+                        help='largest population')
+    parser.add_argument('names', nargs='*', help='glob patterns of dataset names')
+    args = parser.parse_args()
+
+    store = SummaryStore(args.db)
+    if args.output == '-':
+        for row in series(store, args.kind, args.names, args.pmin, args.pmax):
+            sys.stdout.write(_line(row) + "\n")
+        return
+    if not path.isdir(args.output):
+        os.makedirs(args.output)
+    exportseries(store, args.kind, args.output, args.names, args.pmin, args.pmax)
@@ -0,0 +1,179 @@
+import cProfile
+import heapq
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from os import path
+
+log = logging.getLogger("timing")
+
+## the timings that stages are currently recorded into by each
+## thread, if any
+local = threading.local()
+
+def _current():
+    return getattr(local, "timings", None)
+
+def rss():
+    """
+    Current resident set size of this process in kilobytes
+    """
+    with open("/proc/self/statm") as fp:
+        pages = int(fp.read().split()[1])
+    return pages * resource.getpagesize() // 1024
+
+def peak():
+    """
+    Largest resident set size this process has had, in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class Timings(object):
+    """
+    Wall time and memory use of the stages of processing one file.
+    Stages nest, so the time of a stage includes the stages it caused
+    to run, such as memoized mesh properties, and depth tells them
+    apart. Records are in the order that stages finished.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.cells = None
+        self.records = []
+        self.depth = 0
+        self.started = time.time()
+
+    def rows(self):
+        """
+        The records as plain dicts, each with the file and its cell count
+        """
+        return [dict(r, file=self.filename, cells=self.cells) for r in self.records]
+
+@contextmanager
+def recording(timings):
+    """
+    Record stages into timings until the block exits
+    """
+    previous = _current()
+    local.timings = timings
+    try:
+        yield timings
+    finally:
+        local.timings = previous
+
+@contextmanager
+def stage(name):
+    """
+    Time the block as the named stage if timings are being recorded
+    """
+    t = _current()
+    if t is None:
+        yield
+        return
+    start = time.time()
+    t.depth += 1
+    try:
+        yield
+    finally:
+        t.depth -= 1
+        t.records.append({
+            "stage": name,
+            "depth": t.depth,
+            "start": start - t.started,
+            "seconds": time.time() - start,
+            "rss_kb": rss(),
+            "peak_kb": peak(),
+        })
+
+def cells(n):
+    """
+    Note the number of cells in the mesh being timed
+    """
+    t = _current()
+    if t is not None:
+        t.cells = n
+
+def profile_path(directory, filename):
+    name = path.abspath(filename).strip(os.sep).replace(os.sep, "_")
+    return path.join(directory, name + ".prof")
+
+def measure(filename, work, profile=None, name="file"):
+    """
+    Call work() with its stages timed, as a stage called name, and
+    under cProfile if profile names a directory to write the profile
+    of filename to. Returns the result and the Timings.
+    """
+    timings = Timings(filename)
+    prof = None
+    if profile is not None:
+        prof = cProfile.Profile()
+        prof.enable()
+    try:
+        with recording(timings):
+            with stage(name):
+                result = work()
+    finally:
+        if prof is not None:
+            prof.disable()
+    if prof is not None:
+        prof.dump_stats(profile_path(profile, filename))
+    return result, timings
+
+class Slowest(object):
+    """
+    Keeps the profiles of the n slowest files, removing the others
+    """
+    def __init__(self, directory, n):
+        self.directory = directory
+        self.n = n
+        self.heap = []
+        if not path.isdir(directory):
+            os.makedirs(directory)
+
+    def add(self, filename, seconds):
+        heapq.heappush(self.heap, (seconds, profile_path(self.directory, filename)))
+        if len(self.heap) > self.n:
+            _, discard = heapq.heappop(self.heap)
+            try:
+                os.remove(discard)
+            except OSError:
+                pass
+
+class TimingLog(object):
+    """
+    Appends timing records to a file as JSON lines
+    """
+    def __init__(self, filename):
+        self.fp = open(filename, "a")
+
+    def write(self, rows):
+        for row in rows:
+            self.fp.write(json.dumps(row, sort_keys=True) + "\n")
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+def savetimings(db, run, rows):
+    cur = db.conn.cursor()
+    cur.executemany("""
+    INSERT INTO timings(run, file, stage, depth, seconds, cells, rss, peak)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(run, r["file"], r["stage"], r["depth"], r["seconds"], r["cells"],
+           r["rss_kb"], r["peak_kb"]) for r in rows])
+
+def report(rows):
+    """
+    Log the total time spent in each stage
+    """
+    totals = defaultdict(float)
+    calls = defaultdict(int)
+    for r in rows:
+        totals[r["stage"]] += r["seconds"]
+        calls[r["stage"]] += 1
+    for name in sorted(totals, key=totals.get, reverse=True):
+        log.info("%-16s %6d %10.3fs", name, calls[name], totals[name])
@@ -1,20 +1,51 @@
 import argparse
 import csv
+from itertools import islice
 import json
-import pytess
-from sys import float_info
+from sys import float_info, stdout
+import numpy as np
+from mesh import DictMesh, dumpmesh, meshdata, csr_adjacency, prime
 
-def rows_csv(filename, delimiter):
+def csv_chunks(filename, delimiter, columns=(2, 6, 7), thresholds=(300,),
+               chunksize=100000):
+    """
+    Read centroids from a CSV file a chunk of rows at a time, yielding
+    (points, kinds) arrays for each chunk. columns gives the positions
+    of the measurement used to classify cells and of the x and y
+    coordinates. The kind of a cell is the number of thresholds that
+    its measurement does not exceed, so with a single threshold cells
+    above it are kind 0 and the rest kind 1.
+    """
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+    with open(filename) as fp:
+        reader = csv.reader(fp, delimiter=delimiter)
+        while True:
+            rows = list(islice(reader, chunksize))
+            if not rows:
+                return
+            data = np.array([[row[c] for c in columns] for row in rows
+                             if row and row[0].strip() != ''],
+                            dtype=float).reshape(-1, len(columns))
+            kinds = len(thresholds) - np.searchsorted(thresholds, data[:,0])
+            yield data[:,1:3], kinds
+
+def centroids(chunks):
+    """
+    Gather chunks of centroids into single points and kinds arrays
+    """
+    points, kinds = [np.zeros((0, 2))], [np.zeros(0, dtype=int)]
+    for p, k in chunks:
+        points.append(p)
+        kinds.append(k)
+    return np.concatenate(points), np.concatenate(kinds)
+
+def rows_csv(filename, delimiter, **kw):
     """
     Designed to read data from Elise' CSV files
     """
-    for row in csv.reader(open(filename), delimiter=delimiter):
-        if row[0].strip() == '': continue
-        mean = float(row[2])
-        x, y = float(row[6]), float(row[7])
-        if mean > 300: kind = 0
-        else: kind = 1
-        yield ((x, y), kind)
+    for points, kinds in csv_chunks(filename, delimiter, **kw):
+        for pt, kind in zip(points.tolist(), kinds.tolist()):
+            yield (tuple(pt), kind)
 
 def voronoi(rows):
 
@@ -65,6 +96,7 @@ def voronoi(rows):
             if y > maxy: return True
         return False
 
+    import pytess
     polyx = dict(pytess.voronoi(centroids))
     centroids = []
     polygons = []
@@ -100,11 +132,81 @@ def voronoi(rows):
 
     return lattice
 
+def voronoi_scipy(points, kinds):
+    """
+    Same as voronoi() but using scipy.spatial. Polygons come from the
+    Voronoi diagram of the centroids and adjacency straight from its
+    dual, the Delaunay triangulation, whose edges are the pairs of
+    centroids either side of each Voronoi ridge. Cells that are
+    unbounded or reach outside the bounding box of the centroids are
+    dropped, as with pytess.
+    """
+    from scipy.spatial import Voronoi
+
+    ## the last of any repeated centroid wins, as with pytess
+    _, last = np.unique(points[::-1], axis=0, return_index=True)
+    keep = np.sort(len(points) - 1 - last)
+    points, kinds = points[keep], kinds[keep]
+
+    vor = Voronoi(points)
+    regions = [vor.regions[r] for r in vor.point_region]
+    counts = np.array([len(r) for r in regions])
+    vertices = np.array([v for r in regions for v in r], dtype=np.int64)
+    owner = np.repeat(np.arange(len(points)), counts)
+
+    lo, hi = points.min(axis=0), points.max(axis=0)
+    coords = vor.vertices[vertices]
+    outside = (vertices < 0) | (coords < lo).any(axis=1) | (coords > hi).any(axis=1)
+    inside = (counts > 0) & (np.bincount(owner[outside], minlength=len(points)) == 0)
+
+    ## renumber the cells that are kept
+    index = np.cumsum(inside) - 1
+    pairs = vor.ridge_points[inside[vor.ridge_points].all(axis=1)]
+    edges = np.concatenate((index[pairs], index[pairs[:, ::-1]]))
+
+    n = np.count_nonzero(inside)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts[inside], out=offsets[1:])
+    coords = coords[inside[owner]]
+    mesh = DictMesh({
+        "types": kinds[inside],
+        "shape": (n, n),
+        "adjacencies": csr_adjacency((n, n), edges),
+    })
+    prime(mesh, geometry=(offsets, coords))
+    return mesh
+
+def _rows(points, kinds):
+    return zip(map(tuple, points.tolist()), kinds.tolist())
+
+backends = {
+    "pytess": lambda points, kinds: DictMesh(voronoi(_rows(points, kinds))),
+    "scipy": voronoi_scipy,
+}
+
 def main():
     parser = argparse.ArgumentParser(prog='pvoronoi')
     parser.add_argument('data', help='dataset')
     parser.add_argument('-d', default='\t', help="CSV delimiter")
+    parser.add_argument('-b', dest='binary', action='store_true', default=False,
+                        help='write the binary format instead of JSON')
+    parser.add_argument('-B', dest='backend', default='pytess',
+                        choices=sorted(backends.keys()),
+                        help='tessellation backend')
+    parser.add_argument('-c', dest='columns', default='2,6,7',
+                        help='columns of the measurement and x, y coordinates')
+    parser.add_argument('-t', dest='thresholds', default='300',
+                        help='comma separated measurement thresholds between kinds')
     args = parser.parse_args()
-    data = voronoi(rows_csv(args.data, delimiter=args.d))
-
-    print json.dumps(data)
+    columns = tuple(int(c) for c in args.columns.split(','))
+    thresholds = [float(t) for t in args.thresholds.split(',')]
+    points, kinds = centroids(csv_chunks(args.data, args.d, columns, thresholds))
+
+    if args.backend == 'pytess' and not args.binary:
+        print json.dumps(voronoi(_rows(points, kinds)))
+        return
+    mesh = backends[args.backend](points, kinds)
+    if args.binary:
+        dumpmesh(mesh, stdout)
+        return
+    print json.dumps(meshdata(mesh))
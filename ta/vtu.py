@@ -0,0 +1,291 @@
+import base64
+import hashlib
+import mmap
+import re
+import zlib
+from xml.etree import ElementTree
+import numpy as np
+
+from ta.mesh import Mesh, TissueGridException, incidence_adjacency, memoize, topologies
+
+## numpy type codes of the VTK XML DataArray types
+vtk_types = {
+    "Int8": "i1", "UInt8": "u1",
+    "Int16": "i2", "UInt16": "u2",
+    "Int32": "i4", "UInt32": "u4",
+    "Int64": "i8", "UInt64": "u8",
+    "Float32": "f4", "Float64": "f8",
+}
+
+class VtuFile(object):
+    """
+    Reads the DataArrays of a VTK XML unstructured grid straight into
+    numpy arrays, without VTK. The XML is parsed up front, but an
+    array is only decoded when it is asked for. Arrays may be ascii,
+    inline base64 or appended raw or base64 data, optionally zlib
+    compressed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fp:
+            try:
+                self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise TissueGridException("%s is empty" % filename)
+        start = self.data.find(b"<AppendedData")
+        if start < 0:
+            xml = self.data[:]
+            self.appended = None
+        else:
+            tagend = self.data.find(b">", start)
+            tag = self.data[start:tagend]
+            m = re.search(br'encoding="(\w+)"', tag)
+            self.encoding = m.group(1) if m else b"raw"
+            self.appended = self.data.find(b"_", tagend) + 1
+            xml = self.data[:start] + b"</VTKFile>"
+        try:
+            root = ElementTree.fromstring(xml)
+        except ElementTree.ParseError as e:
+            raise TissueGridException("Cannot parse %s: %s" % (filename, e))
+        if root.get("byte_order", "LittleEndian") == "LittleEndian":
+            self.byteorder = "<"
+        else:
+            self.byteorder = ">"
+        self.header = np.dtype(self.byteorder + vtk_types[root.get("header_type", "UInt32")])
+        self.compressor = root.get("compressor")
+        if self.compressor not in (None, "vtkZLibDataCompressor"):
+            raise TissueGridException("Unsupported compressor %s" % self.compressor)
+
+        piece = root.find("UnstructuredGrid").find("Piece")
+        self.npoints = int(piece.get("NumberOfPoints"))
+        self.ncells = int(piece.get("NumberOfCells"))
+        self.sections = {}
+        offsets = []
+        for section in piece:
+            arrays = section.findall("DataArray")
+            self.sections[section.tag] = arrays
+            offsets.extend(int(a.get("offset")) for a in arrays
+                           if a.get("format") == "appended")
+        if self.appended is not None:
+            end = self.data.rfind(b"</AppendedData>")
+            offsets.append(end - self.appended)
+        self.offsets = sorted(set(offsets))
+
+    def names(self, section):
+        return [a.get("Name") for a in self.sections.get(section, [])]
+
+    def element(self, section, name=None):
+        """
+        The DataArray element with the given name in a section of the
+        piece, or the first one if name is None
+        """
+        for a in self.sections.get(section, []):
+            if name is None or a.get("Name") == name:
+                return a
+        return None
+
+    def array(self, section, name=None):
+        """
+        Decode a DataArray, with a row for each tuple if it has more
+        than one component
+        """
+        a = self.element(section, name)
+        if a is None:
+            raise TissueGridException("No %s array %s" % (section, name))
+        dtype = np.dtype(self.byteorder + vtk_types[a.get("type")])
+        format = a.get("format")
+        if format == "ascii":
+            values = np.array(a.text.split(), dtype=dtype)
+        elif format == "binary":
+            values = np.frombuffer(self._base64(a.text), dtype=dtype)
+        elif format == "appended":
+            offset = int(a.get("offset"))
+            if self.encoding == b"raw":
+                values = np.frombuffer(self._raw(self.appended + offset), dtype=dtype)
+            else:
+                end = self.offsets[self.offsets.index(offset) + 1]
+                text = self.data[self.appended + offset:self.appended + end]
+                values = np.frombuffer(self._base64(text), dtype=dtype)
+        else:
+            raise TissueGridException("Unknown DataArray format %s" % format)
+        ncomponents = int(a.get("NumberOfComponents", 1))
+        if ncomponents > 1:
+            values = values.reshape(-1, ncomponents)
+        return values
+
+    def _ints(self, data):
+        return [int(x) for x in np.frombuffer(data, dtype=self.header)]
+
+    def _blocks(self, sizes, body):
+        """
+        Utility function that decompresses consecutive zlib blocks
+        """
+        ends = np.cumsum(sizes)
+        return b"".join(zlib.decompress(body[e - n:e]) for n, e in zip(sizes, ends))
+
+    def _raw(self, pos):
+        size = self.header.itemsize
+        if self.compressor is None:
+            nbytes, = self._ints(self.data[pos:pos + size])
+            return self.data[pos + size:pos + size + nbytes]
+        nblocks = self._ints(self.data[pos:pos + size])[0]
+        start = pos + (3 + nblocks) * size
+        sizes = self._ints(self.data[pos + 3*size:start])
+        return self._blocks(sizes, self.data[start:start + sum(sizes)])
+
+    def _base64(self, text):
+        """
+        Decode base64 data and its header. VTK encodes the header on
+        its own, with padding, and then the data, while other writers
+        encode the two together, so the header is decoded first to
+        tell which was done.
+        """
+        text = b"".join(text.split())
+        size = self.header.itemsize
+        if self.compressor is None:
+            nheader = size
+        else:
+            ## the first three header values are a whole number of
+            ## base64 quanta in either case
+            nblocks = self._ints(base64.b64decode(text[:4*size]))[0]
+            nheader = (3 + nblocks) * size
+        nchars = 4 * -(-nheader // 3)
+        if text[nchars - 1:nchars] == b"=":
+            header = base64.b64decode(text[:nchars])
+            body = base64.b64decode(text[nchars:])
+        else:
+            raw = base64.b64decode(text)
+            header, body = raw[:nheader], raw[nheader:]
+        if self.compressor is None:
+            nbytes, = self._ints(header)
+            return body[:nbytes]
+        return self._blocks(self._ints(header[3*size:]), body)
+
+class VtuMesh(Mesh):
+    """
+    A mesh read from a VTU file. Arrays are read with VtuFile unless
+    native is false, when the file is read with VTK.
+    """
+    def __init__(self, file_name, edges=False, native=True):
+        self.filename = file_name
+        self.edges = edges
+        self.native = native
+
+    def __str__(self):
+        return "VtuMesh(%s)" % repr(self.filename)
+
+    @memoize
+    def vtu(self):
+        return VtuFile(self.filename)
+
+    @memoize
+    def ug(self):
+        from vtk import vtkXMLUnstructuredGridReader
+        reader = vtkXMLUnstructuredGridReader()
+        reader.SetFileName(self.filename)
+        reader.Update()
+        return reader.GetOutput()
+
+    @memoize
+    def npoints(self):
+        if self.native:
+            return self.vtu.npoints
+        return int(self.ug.GetNumberOfPoints())
+
+    @memoize
+    def shape(self):
+        return (len(self), len(self))
+
+    @property
+    def timestamp(self):
+        m = re.match(r"^.*[^0-9]([0-9]*)\.vtu$", self.filename)
+        time, = m.groups()
+        return time
+
+    @memoize
+    def types(self):
+        if self.native:
+            for name in ("cell type", "Cell types"):
+                if self.vtu.element("CellData", name) is not None:
+                    types = self.vtu.array("CellData", name)
+                    if types.ndim > 1:
+                        types = types[:,0]
+                    return types
+            raise TissueGridException("No data about cell types")
+
+        from vtk.util.numpy_support import vtk_to_numpy
+        celldata = self.ug.GetCellData()
+        for name in ("cell type", "Cell types"):
+            data = celldata.GetArray(name)
+            if data is not None:
+                types = vtk_to_numpy(data)
+                if types.ndim > 1:
+                    types = types[:,0]
+                return types
+
+        raise TissueGridException("No data about cell types")
+
+    @memoize
+    def cells(self):
+        """
+        Cell connectivity as an (offsets, connectivity) pair of arrays,
+        the points of cell i are connectivity[offsets[i]:offsets[i+1]]
+        """
+        if self.native:
+            ends = self.vtu.array("Cells", "offsets")
+            offsets = np.zeros(len(ends) + 1, dtype=np.int64)
+            offsets[1:] = ends
+            return offsets, self.vtu.array("Cells", "connectivity")
+
+        from vtk.util.numpy_support import vtk_to_numpy
+        cells = self.ug.GetCells()
+        if hasattr(cells, "GetConnectivityArray"):
+            offsets = vtk_to_numpy(cells.GetOffsetsArray())
+            connectivity = vtk_to_numpy(cells.GetConnectivityArray())
+            return offsets, connectivity
+        # legacy layout, each cell is its point count followed by its points
+        legacy = vtk_to_numpy(cells.GetData())
+        locations = vtk_to_numpy(self.ug.GetCellLocationsArray())
+        counts = legacy[locations]
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        mask = np.ones(len(legacy), dtype=bool)
+        mask[locations] = False
+        return offsets, legacy[mask]
+
+    @memoize
+    def topology(self):
+        offsets, connectivity = self.cells
+        h = hashlib.sha1()
+        h.update(str((self.npoints, self.edges)).encode("ascii"))
+        h.update(np.ascontiguousarray(offsets, dtype=np.int64).tobytes())
+        h.update(np.ascontiguousarray(connectivity, dtype=np.int64).tobytes())
+        return h.hexdigest()
+
+    @memoize
+    def adjacencies(self):
+        offsets, connectivity = self.cells
+        def build():
+            return incidence_adjacency(offsets, connectivity,
+                                       self.npoints, self.edges)
+        return topologies.get(self.topology, "adjacencies", build)
+
+    @memoize
+    def points(self):
+        """
+        Point coordinates as an (npoints, 3) array view
+        """
+        if self.native:
+            return self.vtu.array("Points")
+        from vtk.util.numpy_support import vtk_to_numpy
+        return vtk_to_numpy(self.ug.GetPoints().GetData())
+
+    @memoize
+    def geometry(self):
+        offsets, connectivity = self.cells
+        return offsets, self.points[connectivity, :2]
+
+    @memoize
+    def polygons(self):
+        offsets, coords = self.geometry
+        return np.split(coords, offsets[1:-1])